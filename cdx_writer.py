@@ -2,16 +2,12 @@
 
 """ Copyright(c)2012-2013 Internet Archive. Software license AGPL version 3.
 
-This script requires a modified version of Hanzo Archives' warc-tools:
-http://code.hanzoarchives.com/warc-tools/src/tip/hanzo/warctools
-
 This script is loosely based on warcindex.py:
 http://code.hanzoarchives.com/warc-tools/src/1897e2bc9d29/warcindex.py
 
 The functions that start with "get_" (as opposed to "parse_") are called by the
 dispatch loop in make_cdx using getattr().
 """
-from hanzo.warctools import ArchiveRecord # from https://bitbucket.org/rajbot/warc-tools
 from surt      import surt                # from https://github.com/internetarchive/surt
 
 import os
@@ -19,13 +15,39 @@ import re
 import sys
 import base64
 import chardet
+import functools
+import gzip
 import hashlib
+import heapq
+import itertools
 import json
+import mmap
+import shutil
+import signal
+import struct
+import tempfile
+import time
 import urlparse
+import zlib
+import multiprocessing
+import operator
+from bisect import bisect_right
+from collections import OrderedDict
+from cStringIO import StringIO
 from datetime import datetime
-from operator import attrgetter
+from io import BytesIO
 from optparse import OptionParser
 
+# zlib-compatible modules several times faster at decompression, used for
+# reading gzipped W/ARCs when installed
+try:
+    from isal import isal_zlib as gzip_zlib
+except ImportError:
+    try:
+        from zlib_ng import zlib_ng as gzip_zlib
+    except ImportError:
+        gzip_zlib = zlib
+
 def to_unicode(s, charset):
     if isinstance(s, str):
         if charset is None:
@@ -111,8 +133,217 @@ def urljoin_and_normalize(base, url, charset):
 class ParseError(Exception):
     pass
 
+class cached_property(object):
+    """Like ``property``, but the getter is called only on first access,
+    and its value is stored in the instance for subsequent accesses.
+    Record handlers use it for field values and intermediate parse results,
+    so that only what is needed for the CDX fields in ``--format`` is
+    computed, and only once per record.
+    """
+    def __init__(self, func):
+        self.func = func
+        self.__name__ = func.__name__
+        self.__doc__ = func.__doc__
+
+    def __get__(self, obj, cls=None):
+        if obj is None:
+            return self
+        value = obj.__dict__[self.__name__] = self.func(obj)
+        return value
+
+RE_META_TAG_OR_END = re.compile(r'(<meta[^>]+?>|</head>|<body)', re.I)
+RE_META_NAME = re.compile(r'''\b(?:name|http-equiv)\s*=\s*(['"]?)(.*?)(\1)[\s/>]''', re.I)
+RE_META_CONTENT = re.compile(r'''\bcontent\s*=\s*(['"]?)(.*?)(\1)[\s/>]''', re.I)
+
+def scan_meta_tags(html, size):
+    """Return a dict of meta tags in the first `size` bytes of `html`,
+    before ``</head>`` or ``<body``, keyed by lowercased ``name`` or
+    ``http-equiv`` attribute. Contents of tags with the same name are joined
+    with ``,``, except ``refresh``, for which the first one is kept.
+    `html` is not copied.
+    """
+    meta_tags = {}
+    for m in RE_META_TAG_OR_END.finditer(html, 0, size):
+        tag = m.group(1)
+        if tag[1] in '/bB':
+            break
+        name = RE_META_NAME.search(tag)
+        if not name:
+            continue
+        content = RE_META_CONTENT.search(tag)
+        if not content:
+            continue
+        name = name.group(2).lower()
+        content = content.group(2)
+        if name not in meta_tags:
+            meta_tags[name] = content
+        elif 'refresh' != name:
+            #for redirect urls, we only want the first refresh tag
+            meta_tags[name] += ',' + content
+    return meta_tags
+
+class HttpHeaders(object):
+    r"""Case-insensitive multi-map of HTTP header lines, parsed once per
+    record.
+
+    Values are as matched by ``name:\s*(.+)`` on each line: leading
+    whitespace is removed unless the value is all whitespace (then its
+    last character is kept, so that a blank ``Content-Type`` is told from
+    a missing one), and lines with nothing after ``:`` are ignored.
+    """
+    def __init__(self, lines):
+        self.values = {}
+        for line in lines:
+            name, sep, value = line.partition(':')
+            if not sep:
+                continue
+            stripped = value.lstrip()
+            if stripped:
+                value = stripped
+            elif value:
+                value = value[-1]
+            else:
+                continue
+            self.values.setdefault(name.lower(), []).append(value)
+
+    def get(self, name, default=None):
+        """Return the value of the first header `name`."""
+        values = self.values.get(name.lower())
+        return values[0] if values else default
+
+    def get_all(self, name):
+        """Return a list of values of all headers `name`."""
+        return self.values.get(name.lower(), [])
+
+class RecordPayload(object):
+    """Content block of an archive record.
+
+    In streaming mode (`chunk_size` is given) the block is read from
+    ``record.content_file`` in chunks of `chunk_size` bytes, so that large
+    records are never held in memory as a whole. Otherwise, and when
+    the record has no ``content_file``, the block is taken from
+    ``record.content``. Records read from a memory-mapped file
+    (:class:`MappedRecord`) have the block in ``record.content_buffer``,
+    which is hashed and scanned in place in either mode.
+
+    A streamed block can be consumed only once, but :attr:`head` can be
+    looked at any number of times.
+    """
+    # bytes of a buffered block looked at for the first line
+    peek_size = 4096
+
+    def __init__(self, record, chunk_size=None):
+        self.record = record
+        self.chunk_size = chunk_size
+        self.buffer = getattr(record, 'content_buffer', None)
+        self.stream = None
+        if chunk_size and self.buffer is None:
+            self.stream = getattr(record, 'content_file', None)
+        self._head = None
+
+    @property
+    def head(self):
+        """The first chunk of the block (whole block if neither streaming
+        nor buffered). It is extended to the end of the first line if
+        necessary, so that the HTTP status line can always be parsed from it.
+        """
+        if self._head is None:
+            if self.buffer is not None:
+                size = self.chunk_size or self.peek_size
+                head = self.buffer[:size]
+                while '\n' not in head and len(head) < len(self.buffer):
+                    size *= 2
+                    head = self.buffer[:size]
+                self._head = head
+            elif self.stream is None:
+                self._head = self.record.content[1]
+            else:
+                head = self.stream.read(self.chunk_size)
+                while '\n' not in head:
+                    chunk = self.stream.read(self.chunk_size)
+                    if not chunk:
+                        break
+                    head += chunk
+                self._head = head
+        return self._head
+
+    @property
+    def content_type(self):
+        if self.stream is None and self.buffer is None:
+            return self.record.content[0]
+        return self.record.content_type
+
+    def iter_chunks(self):
+        """Yield the block in chunks, starting with :attr:`head`.
+        """
+        head = self.head
+        if head:
+            yield head
+        if self.buffer is not None:
+            if len(self.buffer) > len(head):
+                yield buffer(self.buffer, len(head))
+        elif self.stream is not None:
+            read = self.stream.read
+            chunk_size = self.chunk_size
+            while True:
+                chunk = read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+
+    def sha1(self):
+        """Return base32-encoded SHA1 digest of the whole block.
+        """
+        h = hashlib.sha1()
+        for chunk in self.iter_chunks():
+            h.update(chunk)
+        return base64.b32encode(h.digest())
+
+RE_HEX_DATE = re.compile('[a-f0-9]+$')
+RE_DATE_WITH_SUFFIX = re.compile('[0-9]{14,18}[a-zA-Z]+$')
+
+DAYS_IN_MONTH = (0, 31, 29, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31)
+
+_warc_date_cache = {}
+
+def warc_date_timestamp(date):
+    """Return 14-digit timestamp for ``WARC-Date`` value `date`, like
+    ``2017-03-03T02:42:45Z``. Fractions of second and time zone are ignored.
+    Recent values are cached, as records in a WARC often share the same
+    second.
+    """
+    date = date[:19]
+    timestamp = _warc_date_cache.get(date)
+    if timestamp is None:
+        timestamp = _parse_warc_date(date)
+        if len(_warc_date_cache) >= 1000:
+            _warc_date_cache.clear()
+        _warc_date_cache[date] = timestamp
+    return timestamp
+
+def _parse_warc_date(date):
+    if (len(date) == 19 and date[4] == '-' and date[7] == '-' and
+            date[10] == 'T' and date[13] == ':' and date[16] == ':'):
+        timestamp = (date[0:4] + date[5:7] + date[8:10] +
+                     date[11:13] + date[14:16] + date[17:19])
+        if timestamp.isdigit():
+            year = int(timestamp[0:4])
+            month = int(timestamp[4:6])
+            day = int(timestamp[6:8])
+            if (year >= 1900 and 1 <= month <= 12 and
+                    1 <= day <= DAYS_IN_MONTH[month] and
+                    (day < 29 or month != 2 or
+                     year % 4 == 0 and (year % 100 != 0 or year % 400 == 0)) and
+                    timestamp[8:10] < '24' and timestamp[10:12] < '60' and
+                    timestamp[12:14] < '60'):
+                return timestamp
+    # anything unusual goes through datetime, which raises ValueError for
+    # invalid dates.
+    date = datetime.strptime(date, "%Y-%m-%dT%H:%M:%S")
+    return date.strftime("%Y%m%d%H%M%S")
+
 class RecordHandler(object):
-    def __init__(self, record, offset, cdx_writer):
+    def __init__(self, record, offset, cdx_writer, payload=None):
         """Defines default behavior for all fields.
         Field values are defined as properties with name
         matching descriptive name in ``field_map``.
@@ -121,11 +352,12 @@ class RecordHandler(object):
         self.offset = offset
         self.cdx_writer = cdx_writer
         self.urlkey = cdx_writer.urlkey
+        self.payload = payload or RecordPayload(record)
 
     def get_record_header(self, name):
         return self.record.get_header(name)
 
-    @property
+    @cached_property
     def massaged_url(self):
         """massaged url / field "N".
         """
@@ -135,7 +367,7 @@ class RecordHandler(object):
         except:
             return self.original_url
 
-    @property
+    @cached_property
     def date(self):
         """date / field "b".
         """
@@ -161,18 +393,21 @@ class RecordHandler(object):
             elif 10 == date_len:
                 #some arc records have 10-digit dates: 2016020900
                 return record.date + '0000'
-        elif re.match('[a-f0-9]+$', record.date):
+        elif RE_HEX_DATE.match(record.date):
             #some arc records have a hex string in the date field
             return None
-        elif re.match('[0-9]{14,18}[a-zA-Z]+$', record.date):
+        elif RE_DATE_WITH_SUFFIX.match(record.date):
             #some arc records are like this: 20160211000000jpg
             return record.date[:14]
 
         #warc record
-        date = datetime.strptime(record.date[:19], "%Y-%m-%dT%H:%M:%S")
-        return date.strftime("%Y%m%d%H%M%S")
+        return warc_date_timestamp(record.date)
 
     def safe_url(self):
+        return self._safe_url
+
+    @cached_property
+    def _safe_url(self):
         url = self.record.url
         # There are few arc files from 2002 that have non-ascii characters in
         # the url field. These are not utf-8 characters, and the charset of the
@@ -196,40 +431,39 @@ class RecordHandler(object):
 
         return url
 
-    @property
+    @cached_property
     def original_url(self):
         """original url / field "a".
         """
         url = self.safe_url()
         return url.encode('latin1')
 
-    @property
+    @cached_property
     def mime_type(self):
         """mime type / field "m".
         """
         return 'warc/' + self.record.type
 
-    @property
+    @cached_property
     def response_code(self):
         """response code / field "s".
         """
         return None
 
-    @property
+    @cached_property
     def new_style_checksum(self):
         """new style checksum / field "k".
         """
-        h = hashlib.sha1(self.record.content[1])
-        return base64.b32encode(h.digest())
+        return self.payload.sha1()
 
-    @property
+    @cached_property
     def redirect(self):
         """redirect / field "r".
         """
         # only meaningful for HTTP response records.
         return None
 
-    @property
+    @cached_property
     def compressed_record_size(self):
         """compressed record size / field "S".
         """
@@ -238,14 +472,14 @@ class RecordHandler(object):
             return None
         return str(size)
 
-    @property
+    @cached_property
     def compressed_arc_file_offset(self):
         """compressed arc file offset / field "V".
         """
         # TODO: offset attribute
         return str(self.offset)
 
-    @property
+    @cached_property
     def aif_meta_tags(self):
         """AIF meta tags / field "M".
         robot metatags, if present, should be in this order:
@@ -253,7 +487,7 @@ class RecordHandler(object):
         """
         return None
 
-    @property
+    @cached_property
     def file_name(self):
         """file name / field "g".
         """
@@ -264,17 +498,17 @@ class WarcinfoHandler(RecordHandler):
     #similar to what what the wayback uses:
     fake_build_version = "archive-commons.0.0.1-SNAPSHOT-20120112102659-python"
 
-    @property
+    @cached_property
     def massaged_url(self):
         return self.original_url
 
-    @property
+    @cached_property
     def original_url(self):
         return 'warcinfo:/%s/%s' % (
-            self.cdx_writer.file, self.fake_build_version
+            self.cdx_writer.file_name, self.fake_build_version
         )
 
-    @property
+    @cached_property
     def mime_type(self):
         return 'warc-info'
 
@@ -284,7 +518,7 @@ class HttpHandler(RecordHandler):
     """
     meta_tags = None
 
-    @property
+    @cached_property
     def redirect(self):
         # Aaron, Ilya, and Kenji have proposed using '-' in the redirect column
         # unconditionally, after a discussion on Sept 5, 2012. It turns out the
@@ -345,24 +579,48 @@ class HttpHandler(RecordHandler):
 class ResponseHandler(HttpHandler):
     """Handler for HTTP response with archived content (``response`` record type).
     """
-    def __init__(self, record, offset, cdx_writer):
-        super(ResponseHandler, self).__init__(record, offset, cdx_writer)
+    def __init__(self, record, offset, cdx_writer, payload=None):
+        super(ResponseHandler, self).__init__(record, offset, cdx_writer, payload)
         self.lxml_parse_limit = cdx_writer.lxml_parse_limit
-        self.headers, self.content = self.parse_headers_and_content()
-        self.meta_tags = self.parse_meta_tags()
+        self.meta_scan_size = cdx_writer.meta_scan_size
+        self.content_digest = None
+
+    # HTTP headers and content are parsed from the payload on first use of
+    # either, and meta tags on first use of them. Formats without fields
+    # needing them ("N b a S V g", for example) skip parsing altogether.
+    @cached_property
+    def _headers_and_content(self):
+        if self.payload.buffer is not None:
+            return self.parse_buffered_payload()
+        elif self.payload.stream is None:
+            return self.parse_headers_and_content()
+        else:
+            return self.parse_streamed_payload()
 
-    response_pattern = re.compile('application/http;\s*msgtype=response$', re.I)
+    @cached_property
+    def headers(self):
+        return self._headers_and_content[0]
 
-    def parse_http_header(self, header_name):
+    @cached_property
+    def content(self):
+        return self._headers_and_content[1]
+
+    @cached_property
+    def http_headers(self):
         if self.headers is None:
             return None
+        return HttpHeaders(self.headers)
 
-        pattern = re.compile(header_name+':\s*(.+)', re.I)
-        for line in iter(self.headers):
-            m = pattern.match(line)
-            if m:
-                return m.group(1)
-        return None
+    @cached_property
+    def meta_tags(self):
+        return self.parse_meta_tags()
+
+    response_pattern = re.compile('application/http;\s*msgtype=response$', re.I)
+
+    def parse_http_header(self, header_name):
+        if self.http_headers is None:
+            return None
+        return self.http_headers.get(header_name)
 
     def parse_http_content_type_header(self):
         content_type = self.parse_http_header('content-type')
@@ -374,15 +632,18 @@ class ResponseHandler(HttpHandler):
         if '' == content_type:
             return 'unk'
 
-        m = re.match('(.+?);', content_type)
+        m = self.content_type_params_pattern.match(content_type)
         if m:
             content_type = m.group(1)
 
-        if re.match('[a-z0-9\-\.\+/]+$', content_type):
+        if self.mime_type_pattern.match(content_type):
             return content_type
         else:
             return 'unk'
 
+    content_type_params_pattern = re.compile('(.+?);')
+    mime_type_pattern = re.compile('[a-z0-9\-\.\+/]+$')
+
     charset_pattern = re.compile('charset\s*=\s*([a-z0-9_\-]+)', re.I)
 
     crlf_pattern = re.compile('\r?\n\r?\n')
@@ -392,25 +653,95 @@ class ResponseHandler(HttpHandler):
         We call splitlines() here so we only split once, and so \r\n and \n are
         split in the same way.
         """
-        if self.record.content[1].startswith('HTTP'):
+        block = self.payload.head
+        if block.startswith('HTTP'):
             # some records with empty HTTP payload end with just one CRLF or
             # LF. If split fails, we assume this situation, and let content be
             # an empty bytes, rather than None, so that payload digest is
             # emitted correctly (see get_new_style_checksum method).
             try:
-                headers, content = self.crlf_pattern.split(self.record.content[1], 1)
+                headers, content = self.crlf_pattern.split(block, 1)
             except ValueError:
-                headers = self.record.content[1]
+                headers = block
                 content = ''
             return headers.splitlines(), content
         else:
             return None, None
 
+    def parse_buffered_payload(self):
+        """Counterpart of :meth:`parse_headers_and_content` for a block in
+        a buffer (memory-mapped file). Only HTTP headers are copied; content
+        is a buffer into the block.
+        """
+        block = self.payload.buffer
+        if block[:4] != 'HTTP':
+            return None, None
+        m = self.crlf_pattern.search(block)
+        if m:
+            headers, content = block[:m.start()], buffer(block, m.end())
+        else:
+            headers, content = block[:], ''
+        return headers.splitlines(), content
+
+    def parse_streamed_payload(self):
+        """Streaming mode counterpart of :meth:`parse_headers_and_content`.
+        HTTP headers are parsed from the first chunk(s) of the payload. The rest
+        is consumed chunk by chunk, computing SHA1 digest when the record has
+        no payload digest, and keeping content only if it is small enough
+        for :meth:`parse_meta_tags` to look at. Hence returned content is
+        empty for large or non-HTML payloads, and only as much as
+        :meth:`parse_meta_tags` looks at (``meta_scan_size`` bytes) is kept.
+        """
+        if not self.payload.head.startswith('HTTP'):
+            return None, None
+
+        chunks = self.payload.iter_chunks()
+        block = ''
+        m = None
+        for chunk in chunks:
+            block += chunk
+            m = self.crlf_pattern.search(block)
+            if m:
+                break
+        if m:
+            headers, rest = block[:m.start()], block[m.end():]
+        else:
+            headers, rest = block, ''
+        self.headers = headers.splitlines()
+
+        if self.get_record_header('WARC-Payload-Digest') is None:
+            h = hashlib.sha1()
+        else:
+            h = None
+        keep = (self.mime_type == 'text/html' and
+                self.record.content_length <= self.lxml_parse_limit)
+        if h is None and not keep:
+            return self.headers, ''
+
+        content = []
+        kept = 0
+        chunk = rest
+        while True:
+            if h is not None:
+                h.update(chunk)
+            if keep:
+                content.append(chunk[:self.meta_scan_size - kept])
+                kept += len(content[-1])
+                keep = kept < self.meta_scan_size
+                if h is None and not keep:
+                    break
+            chunk = next(chunks, None)
+            if chunk is None:
+                break
+        if h is not None:
+            self.content_digest = base64.b32encode(h.digest())
+        return self.headers, ''.join(content)
+
     def is_response(self):
         content_type = self.record.content_type
         return content_type and self.response_pattern.match(content_type)
 
-    @property
+    @cached_property
     def mime_type(self):
         if self.is_response():
             # WARC
@@ -435,28 +766,26 @@ class ResponseHandler(HttpHandler):
     RE_RESPONSE_LINE = re.compile(
         r'HTTP(?P<version>/\d\.\d)? (?P<statuscode>\d+)')
 
-    @property
+    @cached_property
     def response_code(self):
-        m = self.RE_RESPONSE_LINE.match(self.record.content[1])
+        m = self.RE_RESPONSE_LINE.match(self.payload.head)
         return m and m.group('statuscode')
 
-    @property
+    @cached_property
     def new_style_checksum(self):
-        if self.is_response():
-            digest = self.get_record_header('WARC-Payload-Digest')
+        # MappedRecord fabricates WARC-Payload-Digest for arc records and
+        # WARC responses without one, computed on the block in place.
+        # Streamed records leave it to parse_streamed_payload.
+        digest = self.get_record_header('WARC-Payload-Digest')
+        if digest is not None:
             return digest.replace('sha1:', '')
         elif self.content is not None:
-            # This is an arc record. Our patched warctools fabricates the WARC-Payload-Digest
-            # header even for arc files so that we don't need to load large payloads in memory
-            digest = self.get_record_header('WARC-Payload-Digest')
-            if digest is not None:
-                return digest.replace('sha1:', '')
-            else:
-                h = hashlib.sha1(self.content)
-                return base64.b32encode(h.digest())
-        else:
-            h = hashlib.sha1(self.record.content[1])
+            if self.content_digest is not None:
+                return self.content_digest
+            h = hashlib.sha1(self.content)
             return base64.b32encode(h.digest())
+        else:
+            return self.payload.sha1()
 
     def parse_meta_tags(self):
         """We want to parse meta tags in <head>, even if not direct children.
@@ -474,51 +803,17 @@ class ResponseHandler(HttpHandler):
         if self.content is None:
             return None
 
-        meta_tags = {}
-
-        #lxml.html can't parse blank documents
-        html_str = self.content.strip()
-        if '' == html_str:
-            return meta_tags
-
         #lxml can't handle large documents
         if self.record.content_length > self.lxml_parse_limit:
-            return meta_tags
+            return {}
 
         # lxml was working great with ubuntu 10.04 / python 2.6
         # On ubuntu 11.10 / python 2.7, lxml exhausts memory hits the ulimit
         # on the same warc files. Unfortunately, we don't ship a virtualenv,
         # so we're going to give up on lxml and use regexes to parse html :(
+        return scan_meta_tags(self.content, self.meta_scan_size)
 
-        for x in re.finditer("(<meta[^>]+?>|</head>)", html_str, re.I):
-            #we only want to look for meta tags that occur before the </head> tag
-            if x.group(1).lower() == '</head>':
-                break
-            name = None
-            content = None
-
-            m = re.search(r'''\b(?:name|http-equiv)\s*=\s*(['"]?)(.*?)(\1)[\s/>]''', x.group(1), re.I)
-            if m:
-                name = m.group(2).lower()
-            else:
-                continue
-
-            m = re.search(r'''\bcontent\s*=\s*(['"]?)(.*?)(\1)[\s/>]''', x.group(1), re.I)
-            if m:
-                content = m.group(2)
-            else:
-                continue
-
-            if name not in meta_tags:
-                meta_tags[name] = content
-            else:
-                if 'refresh' != name:
-                    #for redirect urls, we only want the first refresh tag
-                    meta_tags[name] += ',' + content
-
-        return meta_tags
-
-    @property
+    @cached_property
     def aif_meta_tags(self):
         x_robots_tag = self.parse_http_header('x-robots-tag')
 
@@ -556,9 +851,9 @@ class ResponseHandler(HttpHandler):
 class ResourceHandler(RecordHandler):
     """HTTP resource record (``resource`` record type).
     """
-    @property
+    @cached_property
     def mime_type(self):
-        return self.record.content[0]
+        return self.payload.content_type
 
 class RevisitHandler(HttpHandler):
     """HTTP revisit record (``revisit`` record type).
@@ -566,7 +861,7 @@ class RevisitHandler(HttpHandler):
     Note that this handler does not override ``mime_type``.
     Hence ``mime_type`` field will always be ``warc/revisit``.
     """
-    @property
+    @cached_property
     def new_style_checksum(self):
         digest = self.get_record_header('WARC-Payload-Digest')
         if digest is None:
@@ -574,24 +869,24 @@ class RevisitHandler(HttpHandler):
         return digest.replace('sha1:', '')
 
 class ScreenshotHandler(RecordHandler):
-    @property
+    @cached_property
     def original_url(self):
         return 'http://web.archive.org/screenshot/' + self.safe_url()
 
-    @property
+    @cached_property
     def massaged_url(self):
         return 'org,archive,web)/screenshot/' + self.urlkey(self.safe_url())
 
-    @property
+    @cached_property
     def mime_type(self):
-        return self.record.content[0]
+        return self.payload.content_type
 
 class FtpHandler(RecordHandler):
-    @property
+    @cached_property
     def mime_type(self):
-        return self.record.content[0]
+        return self.payload.content_type
 
-    @property
+    @cached_property
     def response_code(self):
         """Always return 226 assuming all ftp captures are successful ones.
         Code 226 represents successful completion of file action, and it is
@@ -602,7 +897,7 @@ class FtpHandler(RecordHandler):
         """
         return '226'
 
-    @property
+    @cached_property
     def new_style_checksum(self):
         # For "resource" record, block is also a payload. So
         # Both WARC-Payload-Digest and WARC-Block-Digest is valid.
@@ -614,11 +909,11 @@ class FtpHandler(RecordHandler):
         if digest:
             return digest.replace('sha1:', '')
 
-        h = hashlib.sha1(self.record.content[1])
-        return base64.b32encode(h.digest())
+        return self.payload.sha1()
 
 class RecordDispatcher(object):
     def __init__(self, all_records=False, screenshot_mode=False):
+        self.skip_reason = None
         self.dispatchers = []
         if screenshot_mode:
             self.dispatchers.append(self.dispatch_screenshot)
@@ -629,20 +924,22 @@ class RecordDispatcher(object):
         if all_records:
             self.dispatchers.append(self.dispatch_other)
 
-    def dispatch_screenshot(self, record):
+    def dispatch_screenshot(self, record, payload):
         if record.type == 'metadata':
             content_type = record.content_type
             if content_type and content_type.startswith('image/'):
                 return ScreenshotHandler
         return None
 
-    def dispatch_http(self, record):
+    def dispatch_http(self, record, payload):
         if record.content_type in ('text/dns',):
+            self.skip_reason = 'dns'
             return None
         if record.type == 'response':
             # exclude 304 Not Modified responses (unless --all-records)
-            m = ResponseHandler.RE_RESPONSE_LINE.match(record.content[1])
+            m = ResponseHandler.RE_RESPONSE_LINE.match(payload.head)
             if m and m.group('statuscode') == '304':
+                self.skip_reason = '304'
                 return None
             # discard ARC records for failed liveweb proxy
             ipaddr = record.get_header('IP-address')
@@ -652,17 +949,19 @@ class RecordDispatcher(object):
                 # status.
                 if (m and m.group('version') is None and
                     m.group('statuscode') in ('502', '504')):
+                    self.skip_reason = 'proxy_failure'
                     return False
             return ResponseHandler
         elif record.type == 'revisit':
             # exclude 304 Not Modified revisits (unless --all-records)
             if record.get_header('WARC-Profile') and record.get_header(
                     'WARC-Profile').endswith('/revisit/server-not-modified'):
+                self.skip_reason = '304'
                 return None
             return RevisitHandler
         return None
 
-    def dispatch_resource(self, record):
+    def dispatch_resource(self, record, payload):
         if record.type == 'resource':
             # wget saves resource records with wget agument and logging
             # output at the end of the WARC. those need to be skipped.
@@ -672,7 +971,7 @@ class RecordDispatcher(object):
                 return ResourceHandler
         return None
 
-    def dispatch_other(self, record):
+    def dispatch_other(self, record, payload):
         if record.type == 'warcinfo':
             return WarcinfoHandler
         elif record.type == 'response':
@@ -682,21 +981,1253 @@ class RecordDispatcher(object):
         else:
             return RecordHandler
 
-    def get_handler(self, record, **kwargs):
+    def get_handler(self, record, payload=None, **kwargs):
+        """Return a handler for `record`, or ``None`` if `record` is not
+        indexed, with the reason in `skip_reason`.
+        """
+        if payload is None:
+            payload = RecordPayload(record)
+        self.skip_reason = 'record_type'
         for disp in self.dispatchers:
-            handler = disp(record)
+            handler = disp(record, payload)
             if handler is False:
                 break
             if handler:
-                return handler(record, **kwargs)
+                return handler(record, payload=payload, **kwargs)
         return None
 
+class FileRange(object):
+    """Read-only file-like view of bytes `start` to `end` of file `fh`.
+    Positions are relative to `start`, so that the range looks like a whole
+    file to archive readers.
+    """
+    def __init__(self, fh, start, end):
+        self.fh = fh
+        self.start = start
+        self.end = end
+        self.pos = 0
+        fh.seek(start)
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.pos
+        elif whence == 2:
+            offset += self.end - self.start
+        self.pos = max(0, min(offset, self.end - self.start))
+        self.fh.seek(self.start + self.pos)
+
+    def read(self, size=-1):
+        remaining = self.end - self.start - self.pos
+        if size < 0 or size > remaining:
+            size = remaining
+        data = self.fh.read(size)
+        self.pos += len(data)
+        return data
+
+    def readline(self, size=-1):
+        remaining = self.end - self.start - self.pos
+        if size < 0 or size > remaining:
+            size = remaining
+        data = self.fh.readline(size)
+        self.pos += len(data)
+        return data
+
+    def close(self):
+        self.fh.close()
+
+class StreamFile(object):
+    """Read-only file-like view of non-seekable stream `fh` (a pipe, for
+    example), read in blocks of `blocksize` bytes. Position is counted from
+    the start, so that archive readers can tell record offsets. Seeking
+    forward reads and discards data; seeking backward is possible only
+    within the current block (enough for peeking at magic bytes). `fh` is
+    not closed.
+    """
+    def __init__(self, fh, blocksize=1024*1024):
+        self.fh = fh
+        self.blocksize = blocksize
+        self.block = ''
+        # stream position of the start of block, and position in block
+        self.block_start = 0
+        self.i = 0
+
+    def _next_block(self):
+        self.block_start += len(self.block)
+        self.block = self.fh.read(self.blocksize)
+        self.i = 0
+        return self.block
+
+    def tell(self):
+        return self.block_start + self.i
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.tell()
+        elif whence != 0:
+            raise IOError('cannot seek from the end of a stream')
+        if offset < self.block_start:
+            raise IOError('cannot seek backward in a stream')
+        while offset > self.block_start + len(self.block):
+            if not self._next_block():
+                # end of stream
+                return
+        self.i = offset - self.block_start
+
+    def read(self, size=-1):
+        out = []
+        while size != 0:
+            if self.i == len(self.block) and not self._next_block():
+                break
+            j = len(self.block)
+            if size > 0:
+                j = min(j, self.i + size)
+                size -= j - self.i
+            out.append(self.block[self.i:j])
+            self.i = j
+        return ''.join(out)
+
+    def readline(self, size=-1):
+        out = []
+        while size != 0:
+            if self.i == len(self.block) and not self._next_block():
+                break
+            j = self.block.find('\n', self.i) + 1 or len(self.block)
+            if size > 0:
+                j = min(j, self.i + size)
+                size -= j - self.i
+            out.append(self.block[self.i:j])
+            self.i = j
+            if self.block[j - 1] == '\n':
+                break
+        return ''.join(out)
+
+    def close(self):
+        pass
+
+class SpoolFile(object):
+    """Read-only file-like view of :class:`StreamFile` `fh` that can also
+    seek backward, to any position after the last :meth:`release`. Data
+    read from `fh` is kept in a temporary file, in memory up to `max_size`
+    bytes, so that large gzip members of a stream can be decompressed
+    again by :class:`GzipMemberFile`. `fh` is not closed.
+    """
+    def __init__(self, fh, max_size=1024*1024):
+        self.fh = fh
+        self.max_size = max_size
+        self.spool = tempfile.SpooledTemporaryFile(max_size)
+        # stream positions of the start and end of spool
+        self.spool_start = self.spool_end = self.pos = fh.tell()
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.pos
+        elif whence != 0:
+            raise IOError('cannot seek from the end of a stream')
+        if offset < self.spool_start:
+            raise IOError('cannot seek backward past released data')
+        if offset > self.spool_end:
+            self.pos = self.spool_end
+            self.read(offset - self.spool_end)
+        else:
+            self.pos = offset
+
+    def read(self, size=-1):
+        out = []
+        if self.pos < self.spool_end:
+            n = self.spool_end - self.pos
+            if size >= 0:
+                n = min(n, size)
+                size -= n
+            self.spool.seek(self.pos - self.spool_start)
+            out.append(self.spool.read(n))
+            self.spool.seek(0, 2)
+            self.pos += n
+        if size != 0:
+            data = self.fh.read(size)
+            self.spool.write(data)
+            self.spool_end += len(data)
+            self.pos += len(data)
+            out.append(data)
+        return ''.join(out)
+
+    def release(self, offset):
+        """Drop data before stream position `offset`; it can't be read
+        again.
+        """
+        if offset <= self.spool_start:
+            return
+        self.spool.seek(min(offset, self.spool_end) - self.spool_start)
+        rest = self.spool.read()
+        self.spool.close()
+        self.spool = tempfile.SpooledTemporaryFile(self.max_size)
+        self.spool.write(rest)
+        self.spool_start = self.spool_end - len(rest)
+        self.pos = max(self.pos, self.spool_start)
+
+    def close(self):
+        self.spool.close()
+
+GZIP_MAGIC = '\x1f\x8b\x08'
+
+def find_warc_member(fh, pos, end, blocksize=1024*1024):
+    """Return offset of the first gzip member in `fh` starting at or after
+    `pos` (and before `end`) whose content begins with a WARC record,
+    or ``None`` if there's none. Candidates are found by gzip magic bytes,
+    and verified by decompressing their first bytes, as the magic bytes
+    may appear in compressed data by chance.
+    """
+    while pos < end:
+        fh.seek(pos)
+        # overlap blocks, so that magic bytes at the boundary are not missed
+        block = fh.read(min(blocksize, end - pos) + len(GZIP_MAGIC) - 1)
+        i = block.find(GZIP_MAGIC)
+        while i >= 0 and pos + i < end:
+            fh.seek(pos + i)
+            try:
+                head = zlib.decompressobj(16 + zlib.MAX_WBITS).decompress(
+                    fh.read(4096), 8)
+            except zlib.error:
+                head = ''
+            if head.startswith('WARC/'):
+                return pos + i
+            i = block.find(GZIP_MAGIC, i + 1)
+        pos += blocksize
+    return None
+
+class MemberScanner(object):
+    """Finds gzip members fully written to growing file `fh`, from offset
+    `pos` on. Decompressor state is kept between calls of :meth:`scan`, so
+    that a member being written is decompressed only once. Zero padding
+    between members is skipped.
+    """
+    def __init__(self, fh, pos=0, blocksize=64*1024):
+        self.fh = fh
+        self.blocksize = blocksize
+        # end of the last complete member, and of data scanned
+        self.done = self.pos = pos
+        # decompressor of the member being written, if any
+        self.d = None
+
+    def scan(self, end):
+        """Scan data up to `end` (size of the file), and return the end
+        offset of the last complete member. Raise :class:`ParseError` on
+        data that is not gzip.
+        """
+        self.fh.seek(self.pos)
+        while self.pos < end:
+            data = self.fh.read(min(self.blocksize, end - self.pos))
+            if not data:
+                break
+            self.pos += len(data)
+            while data:
+                if self.d is None:
+                    data = data.lstrip('\0')
+                    if not data:
+                        break
+                    self.d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                try:
+                    # output is discarded, and limited to bound memory use
+                    self.d.decompress(data, self.blocksize)
+                except zlib.error as ex:
+                    raise ParseError('{} in gzip member at offset {}'.format(
+                        ex, self.pos - len(data)))
+                if self.d.unused_data:
+                    data = self.d.unused_data
+                    self.done = self.pos - len(data)
+                    self.d = None
+                else:
+                    data = self.d.unconsumed_tail
+        if self.d is not None and gzip_member_ended(self.d):
+            # last member ends exactly at end
+            self.done = self.pos
+            self.d = None
+        return self.done
+
+def gzip_member_ended(d):
+    """Return whether gzip decompressor `d` has read its member to the end
+    (the trailer), so that a member cut short can be told from a complete
+    one. zlib of Python 2 has no ``eof`` attribute: a copy of `d` is given
+    one more byte, which it leaves unused only after the end.
+    """
+    if d.unused_data:
+        return True
+    if hasattr(d, 'eof'):
+        return d.eof
+    d = d.copy()
+    try:
+        d.decompress('\0')
+    except gzip_zlib.error:
+        return False
+    return bool(d.unused_data)
+
+def gzip_members(fh, blocksize=1024*1024, head_complete=None):
+    """Yield ``(offset, length, data, size)`` for each gzip member in `fh`
+    from its current position, where `offset` and `length` are exact
+    position and size of the compressed member, `data` is the decompressed
+    member, and `size` is its size. If `head_complete` is given, `data` is
+    only the start of decompressed member, up to when
+    ``head_complete(data)`` is true; the rest is discarded as it is made.
+    Zero padding between and after members is skipped, as by the ``gzip``
+    module, and a truncated last member raises :class:`ParseError`. Input
+    is read in blocks of `blocksize` bytes.
+    """
+    start = pos = fh.tell()
+    d = gzip_zlib.decompressobj(16 + zlib.MAX_WBITS)
+    out = []
+    size = 0
+    keep = True
+    # no input given to d yet
+    fresh = True
+    while True:
+        data = fh.read(blocksize)
+        if not data:
+            break
+        pos += len(data)
+        while data:
+            if fresh:
+                stripped = data.lstrip('\0')
+                start += len(data) - len(stripped)
+                data = stripped
+                if not data:
+                    break
+                fresh = False
+            try:
+                # output is limited to bound memory use when discarded
+                chunk = d.decompress(data, blocksize)
+            except gzip_zlib.error as ex:
+                raise ParseError('{} in gzip member at offset {}'.format(
+                    ex, start))
+            size += len(chunk)
+            if keep:
+                out.append(chunk)
+                if head_complete is not None:
+                    out = [''.join(out)]
+                    keep = not head_complete(out[0])
+            if d.unused_data:
+                data = d.unused_data
+                end = pos - len(data)
+                yield start, end - start, ''.join(out), size
+                start = end
+                d = gzip_zlib.decompressobj(16 + zlib.MAX_WBITS)
+                out = []
+                size = 0
+                keep = True
+                fresh = True
+            else:
+                data = d.unconsumed_tail
+    if not fresh:
+        if not gzip_member_ended(d):
+            raise ParseError('truncated gzip member at offset {}'.format(start))
+        chunk = d.flush()
+        size += len(chunk)
+        if keep:
+            out.append(chunk)
+        yield start, pos - start, ''.join(out), size
+
+ARC_V1_FIELDS = ['URL', 'IP-address', 'Archive-date', 'Content-type',
+                 'Archive-length']
+
+RE_IP_ADDRESS = re.compile(r'\d{1,3}(\.\d{1,3}){3}$')
+
+def parse_arc_header(line, fields=ARC_V1_FIELDS):
+    """Return a list of ``(field name, value)`` from ARC record header `line`,
+    with field names `fields` from the version block of the ARC file.
+
+    Version 1 header is split on the IP address, as URLs may have spaces in
+    them, and some ARC files have date and IP address transposed.
+    """
+    tokens = line.rstrip('\r\n').split(' ')
+    if len(tokens) != len(fields) and len(fields) != 5 and len(tokens) >= 5:
+        fields = ARC_V1_FIELDS
+    if len(fields) != 5:
+        values = tokens
+    else:
+        i = None
+        for k in range(1, len(tokens) - 1):
+            if RE_IP_ADDRESS.match(tokens[k]):
+                i = k
+                break
+        if i is None:
+            url, ip, date = ' '.join(tokens[:-4]), tokens[-4], tokens[-3]
+            rest = tokens[-2:-1]
+        elif (i >= 2 and re.match(r'\d{8,}', tokens[i-1]) and
+              len(tokens) - i < 4):
+            url, date, ip = ' '.join(tokens[:i-1]), tokens[i-1], tokens[i]
+            rest = tokens[i+1:-1]
+        else:
+            url, ip, date = ' '.join(tokens[:i]), tokens[i], tokens[i+1]
+            rest = tokens[i+2:-1]
+        content_type = ' '.join(rest).split(';')[0].strip() or None
+        values = [url, ip, date, content_type, tokens[-1]]
+    return [(name, value or None) for name, value in zip(fields, values)]
+
+class HeaderRecord(object):
+    """Archive record read by :class:`HeaderReader`. It has record headers,
+    but only the first line of the content block (enough for
+    :class:`RecordDispatcher` to find HTTP status code). Attributes are
+    those used by record handlers, common to records of all readers.
+    """
+    def __init__(self, headers, block_length, head, arc=False):
+        self.headers = headers
+        self.content_length = max(block_length, 0)
+        self.head = head
+        self.compressed_record_size = None
+        if arc:
+            self.CONTENT_LENGTH = 'Archive-length'
+            self.url = self.get_header('URL')
+            self.type = 'filedesc' if self.url.startswith('filedesc:') else 'response'
+            self.date = self.get_header('Archive-date')
+            self.content_type = self.get_header('Content-type')
+        else:
+            self.CONTENT_LENGTH = 'Content-Length'
+            self.url = self.get_header('WARC-Target-URI')
+            self.type = self.get_header('WARC-Type')
+            self.date = self.get_header('WARC-Date')
+            self.content_type = self.get_header('Content-Type')
+
+    def get_header(self, name):
+        name = name.lower()
+        for k, v in self.headers:
+            if k.lower() == name:
+                return v
+        return None
+
+    @property
+    def content(self):
+        return self.content_type, self.head
+
+class HeaderReader(object):
+    """Reads record headers from WARC or ARC file `fh`, gzipped or not,
+    skipping content blocks: they are seeked over in uncompressed files,
+    and decompressed without keeping the output in gzipped files.
+    Yields ``(offset, record, errors)`` with records of
+    :class:`HeaderRecord`. `errors` is always empty, as malformed records
+    raise :class:`ParseError`.
+    """
+    # bytes of content block kept in HeaderRecord.head (up to end of line)
+    peek_size = 4096
+    # bytes after a record in a gzip member taken for its trailer, not for
+    # more records
+    trailer_size = 16
+
+    def __init__(self, fh, blocksize=64*1024):
+        self.fh = fh
+        self.blocksize = blocksize
+        # field names from ARC version block
+        self.arc_fields = ARC_V1_FIELDS
+
+    def close(self):
+        self.fh.close()
+
+    def read_records(self, limit=None, offsets=True):
+        start = self.fh.tell()
+        magic = self.fh.read(2)
+        self.fh.seek(start)
+        if magic == GZIP_MAGIC[:2]:
+            return self._read_gzip_records()
+        else:
+            return self._read_records(self.fh)
+
+    def _read_records(self, fh):
+        while True:
+            offset, record = self.read_record(fh)
+            if record is None:
+                return
+            end = fh.tell() - len(record.head) + record.content_length
+            fh.seek(end)
+            record.compressed_record_size = end - offset
+            yield offset, record, ()
+
+    def _release(self, offset):
+        # members before offset are not decompressed again
+        if isinstance(self.fh, SpoolFile):
+            self.fh.release(offset)
+
+    def _read_gzip_records(self):
+        members = gzip_members(self.fh, self.blocksize, self._head_complete)
+        for offset, length, head, size in members:
+            self._release(offset)
+            f = BytesIO(head)
+            if len(head) < size:
+                # only the first record is sure to be whole in head: the
+                # member is decompressed again if more than a trailer
+                # follows it (a whole file gzipped as one, for example)
+                record = self.read_record(f)[1]
+                if record is None:
+                    continue
+                end = f.tell() - len(record.head) + record.content_length
+                record.compressed_record_size = length
+                yield offset, record, ()
+                if size - end <= self.trailer_size:
+                    continue
+                f = StreamFile(GzipMemberFile(self.fh, offset), self.blocksize)
+                f.seek(end)
+            # empty members have no records
+            for _, record, _ in self._read_records(f):
+                record.compressed_record_size = length
+                yield offset, record, ()
+
+    def read_record(self, f):
+        """Read a record header and first line of content block from file
+        `f`. Return ``(offset, record)``, or ``(None, None)`` at the end of
+        file.
+        """
+        offset, headers, length, arc = self.read_header(f)
+        if headers is None:
+            return None, None
+        head = f.readline(min(length, self.peek_size)) if length > 0 else ''
+        return offset, HeaderRecord(headers, length, head, arc)
+
+    def _read_blocks(self, fh, max_block_size=None, block_file=None):
+        """Yield ``(offset, record)`` for records in uncompressed file `fh`,
+        read sequentially with content blocks in memory
+        (:class:`MappedRecord`), except that blocks larger than
+        `max_block_size`, if given, are skipped over for
+        :class:`StreamedRecord`, with content file
+        ``block_file(start, end)``, by default a :class:`FileRange` of `fh`
+        (to be read before the next record).
+        """
+        if block_file is None:
+            block_file = lambda start, end: FileRange(fh, start, end)
+        while True:
+            offset, headers, block_length, arc = self.read_header(fh)
+            if headers is None:
+                return
+            start = fh.tell()
+            end = start + max(block_length, 0)
+            if max_block_size is not None and block_length > max_block_size:
+                content_file = block_file(start, end)
+                record = StreamedRecord(headers, block_length, content_file, arc)
+                record.compressed_record_size = end - offset
+                yield offset, record
+                fh.seek(end)
+            else:
+                block = fh.read(end - start)
+                record = MappedRecord(headers, buffer(block), arc)
+                record.compressed_record_size = fh.tell() - offset
+                yield offset, record
+
+    def read_header(self, f):
+        """Read a record header from file `f`, leaving `f` at the start of
+        content block. Return ``(offset, headers, block_length, arc)``, or
+        ``(None, None, None, None)`` at the end of file.
+        """
+        line = f.readline()
+        while line and not line.strip():
+            line = f.readline()
+        if not line:
+            return None, None, None, None
+        offset = f.tell() - len(line)
+        arc = not line.startswith('WARC/')
+        if arc:
+            headers = parse_arc_header(line, self.arc_fields)
+            length = self._parse_length(
+                dict(headers).get('Archive-length'), offset)
+            if line.startswith('filedesc:'):
+                # version block; Archive-length includes it
+                version = f.readline()
+                fields = f.readline()
+                self.arc_fields = fields.split()
+                length -= len(version) + len(fields)
+        else:
+            headers = []
+            for line in iter(f.readline, ''):
+                line = line.rstrip('\r\n')
+                if not line:
+                    break
+                if line[0] in ' \t' and headers:
+                    # continuation line
+                    headers[-1] = (headers[-1][0],
+                                   headers[-1][1] + ' ' + line.strip())
+                elif ':' in line:
+                    name, value = line.split(':', 1)
+                    headers.append((name, value.strip()))
+            length = self._parse_length(
+                dict(headers).get('Content-Length'), offset)
+        return offset, headers, length, arc
+
+    def _parse_length(self, length, offset):
+        try:
+            return int(length)
+        except (TypeError, ValueError):
+            raise ParseError('invalid record length {!r} at offset {}'.format(
+                length, offset))
+
+    RE_HEADER_END = re.compile(r'\n\r?\n')
+
+    def _head_complete(self, head):
+        """Tell if decompressed `head` of a gzip member has record header
+        and the first line of content block.
+        """
+        if len(head) < self.peek_size:
+            return False
+        if head.lstrip().startswith('WARC/'):
+            return self.RE_HEADER_END.search(head) is not None
+        # ARC header is a line, filedesc has two more lines
+        return head.count('\n') >= 4
+
+class MappedRecord(HeaderRecord):
+    """Archive record read by :class:`MappedReader` or
+    :class:`GzipMemberReader`. Its content block ``content_buffer`` is a
+    ``buffer`` into the memory-mapped file or decompressed gzip member,
+    which is not copied unless :attr:`content` is used.
+
+    Like the patched warc-tools cdx_writer once depended on,
+    ``WARC-Payload-Digest`` is fabricated for ARC records and WARC responses
+    without one, if the block is an HTTP message. It is computed on first
+    use.
+    """
+    RE_PAYLOAD_SEPARATOR = re.compile(r'(?:\r\n|\n|\r(?!\n)){2}')
+
+    def __init__(self, headers, content_buffer, arc=False):
+        super(MappedRecord, self).__init__(headers, len(content_buffer), None, arc)
+        self.content_buffer = content_buffer
+        self.arc = arc
+
+    def get_header(self, name):
+        value = super(MappedRecord, self).get_header(name)
+        if (value is None and name.lower() == 'warc-payload-digest' and
+                (self.arc or self.type == 'response') and
+                self.content_buffer[:4] == 'HTTP'):
+            m = self.RE_PAYLOAD_SEPARATOR.search(self.content_buffer)
+            payload = buffer(self.content_buffer, m.end()) if m else ''
+            value = 'sha1:' + base64.b32encode(hashlib.sha1(payload).digest())
+            self.headers.append(('WARC-Payload-Digest', value))
+        return value
+
+    @property
+    def content(self):
+        return self.content_type, self.content_buffer[:]
+
+class MappedReader(HeaderReader):
+    """Reads records from uncompressed WARC or ARC file `fh` mapped into
+    memory. Record headers are parsed from the map, and content blocks are
+    skipped by seeking, leaving them to record handlers as buffers into the
+    map (:class:`MappedRecord`). Yields the same ``(offset, record, errors)``
+    as :class:`HeaderReader`.
+    """
+    def __init__(self, fh):
+        super(MappedReader, self).__init__(fh)
+        # empty file cannot be mapped
+        if os.fstat(fh.fileno()).st_size > 0:
+            self.map = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self.map = None
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+        self.fh.close()
+
+    def read_records(self, limit=None, offsets=True):
+        m = self.map
+        if m is None:
+            return
+        m.seek(self.fh.tell())
+        size = len(m)
+        while True:
+            offset, headers, length, arc = self.read_header(m)
+            if headers is None:
+                return
+            start = m.tell()
+            end = min(start + max(length, 0), size)
+            record = MappedRecord(headers, buffer(m, start, end - start), arc)
+            m.seek(end)
+            record.compressed_record_size = end - offset
+            yield offset, record, ()
+
+class StreamedRecord(HeaderRecord):
+    """Archive record read by :class:`GzipMemberReader` or
+    :class:`StreamReader` with content block too large to hold in memory.
+    The block can be read once from ``content_file``
+    (:class:`GzipMemberFile` or :class:`FileRange`). ``WARC-Payload-Digest``
+    is not fabricated; record handlers compute the digest as they read the
+    block.
+    """
+    def __init__(self, headers, block_length, content_file, arc=False):
+        super(StreamedRecord, self).__init__(headers, block_length, None, arc)
+        self.content_file = content_file
+
+class GzipMemberFile(object):
+    """Read-only file-like view of decompressed bytes `start` to `end` (end
+    of member if ``None``) of gzip member at `offset` in file `fh`. The
+    member is decompressed again as it is read, `blocksize` bytes at a time.
+    Position of `fh` is restored after each read, as :func:`gzip_members`
+    reads it sequentially.
+    """
+    def __init__(self, fh, offset, start=0, end=None, blocksize=64*1024):
+        self.fh = fh
+        self.offset = offset
+        self.in_pos = offset
+        self.start = start
+        self.end = end
+        self.blocksize = blocksize
+        # position in decompressed member
+        self.pos = 0
+        self.d = gzip_zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.data = ''
+
+    def read(self, size=-1):
+        end = self.end if self.end is not None else sys.maxsize
+        if size >= 0:
+            end = min(end, max(self.pos, self.start) + size)
+        out = []
+        saved = self.fh.tell()
+        try:
+            # unused_data is set at end of member, unconsumed_tail may not
+            # be emptied
+            while self.pos < end and not self.d.unused_data:
+                if not self.data:
+                    self.fh.seek(self.in_pos)
+                    self.data = self.fh.read(self.blocksize)
+                    if not self.data:
+                        if not gzip_member_ended(self.d):
+                            raise ParseError(
+                                'truncated gzip member at offset {}'.format(
+                                    self.offset))
+                        break
+                    self.in_pos += len(self.data)
+                try:
+                    chunk = self.d.decompress(
+                        self.data, min(end - self.pos, self.blocksize))
+                except gzip_zlib.error as ex:
+                    raise ParseError('{} in gzip member at offset {}'.format(
+                        ex, self.offset))
+                self.data = self.d.unconsumed_tail
+                skip = self.start - self.pos
+                self.pos += len(chunk)
+                out.append(chunk[skip:] if skip > 0 else chunk)
+        finally:
+            self.fh.seek(saved)
+        return ''.join(out)
+
+class GzipMemberReader(HeaderReader):
+    """Reads records from gzipped WARC or ARC file `fh`, usually one record
+    per gzip member. Members are decompressed whole by :func:`gzip_members`,
+    reading `blocksize` bytes of input at a time, and records are
+    :class:`MappedRecord` with content block in a buffer into the
+    decompressed member. If `max_member_size` is given, members larger
+    than that (decompressed) are not kept: they are decompressed again for
+    reading their records, with blocks larger than `max_member_size` in
+    :class:`StreamedRecord`. Like ``hanzo.warctools``, all records in a
+    member with many (a whole file gzipped as one, for example) have its
+    offset and length. Yields the same ``(offset, record, errors)`` as
+    :class:`HeaderReader`.
+    """
+    def __init__(self, fh, blocksize=1024*1024, max_member_size=None):
+        super(GzipMemberReader, self).__init__(fh, blocksize)
+        self.max_member_size = max_member_size
+
+    def _member_complete(self, data):
+        return len(data) >= self.max_member_size
+
+    def read_records(self, limit=None, offsets=True):
+        if self.max_member_size is None:
+            members = gzip_members(self.fh, self.blocksize)
+        else:
+            members = gzip_members(self.fh, self.blocksize,
+                                   self._member_complete)
+        for offset, length, data, size in members:
+            self._release(offset)
+            if len(data) == size:
+                records = self._buffer_records(data)
+            else:
+                member = StreamFile(GzipMemberFile(self.fh, offset),
+                                    self.blocksize)
+                block_file = functools.partial(GzipMemberFile, self.fh, offset)
+                records = (record for _, record in self._read_blocks(
+                    member, self.max_member_size, block_file))
+            # empty members have no records
+            for record in records:
+                record.compressed_record_size = length
+                yield offset, record, ()
+
+    def _buffer_records(self, data):
+        """Yield records in decompressed member `data`, until only
+        whitespace is left.
+        """
+        # StringIO doesn't copy data
+        f = StringIO(data)
+        while True:
+            headers, block_length, arc = self.read_header(f)[1:]
+            if headers is None:
+                return
+            start = f.tell()
+            end = min(start + max(block_length, 0), len(data))
+            f.seek(end)
+            yield MappedRecord(headers, buffer(data, start, end - start), arc)
+
+class StreamReader(HeaderReader):
+    """Reads records from uncompressed WARC or ARC stream `fh`
+    (:class:`StreamFile`), which cannot be memory-mapped. Content blocks
+    are read into memory for :class:`MappedRecord`, except that, if
+    `max_block_size` is given, larger blocks are left in the stream for
+    :class:`StreamedRecord`, and skipped over unless read before the next
+    record. Yields the same ``(offset, record, errors)`` as
+    :class:`HeaderReader`.
+    """
+    def __init__(self, fh, max_block_size=None):
+        super(StreamReader, self).__init__(fh)
+        self.max_block_size = max_block_size
+
+    def read_records(self, limit=None, offsets=True):
+        for offset, record in self._read_blocks(self.fh, self.max_block_size):
+            yield offset, record, ()
+
+class PrefixSet(object):
+    """Set of prefixes, answering whether any of them is a prefix of a given
+    string in O(log(number of prefixes)) time.
+
+    Prefixes are kept sorted, with redundant ones (those starting with
+    another prefix in the set) removed. Then the only candidate prefix of
+    a string is the greatest prefix not greater than the string, which is
+    found with binary search.
+    """
+    def __init__(self, prefixes):
+        self.prefixes = []
+        for prefix in sorted(set(prefixes)):
+            if self.prefixes and prefix.startswith(self.prefixes[-1]):
+                continue
+            self.prefixes.append(prefix)
+
+    @classmethod
+    def from_sorted(cls, prefixes):
+        """Make :class:`PrefixSet` from a sequence of prefixes already sorted
+        and free of redundant ones, such as :class:`MappedPrefixList`.
+        """
+        pset = cls(())
+        pset.prefixes = prefixes
+        return pset
+
+    def __len__(self):
+        return len(self.prefixes)
+
+    def match(self, s):
+        """Return ``True`` if any prefix in the set is a prefix of `s`.
+        """
+        i = bisect_right(self.prefixes, s)
+        return i > 0 and s.startswith(self.prefixes[i - 1])
+
+class MappedPrefixList(object):
+    """Read-only sequence of prefixes stored in a compiled exclude list file,
+    which is memory-mapped, so that processes using the same file share its
+    pages. See :func:`compile_exclude_list` for the file layout.
+    """
+    MAGIC = 'CDXEXC01'
+    HEADER = struct.Struct('<8s20sQ') # magic, fingerprint, number of prefixes
+    OFFSET = struct.Struct('<Q')
+    OFFSETS = struct.Struct('<2Q')
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size < self.HEADER.size:
+                raise ValueError('{}: truncated exclude cache'.format(path))
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.fingerprint, self.size = self.HEADER.unpack_from(self.map)
+        if magic != self.MAGIC:
+            raise ValueError('{}: not an exclude cache'.format(path))
+        self.data_start = self.HEADER.size + self.OFFSET.size * (self.size + 1)
+        # the last offset is the size of prefixes
+        if (len(self.map) < self.data_start or len(self.map) !=
+                self.data_start + self.OFFSET.unpack_from(
+                    self.map, self.data_start - self.OFFSET.size)[0]):
+            raise ValueError('{}: truncated exclude cache'.format(path))
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.size
+        if not 0 <= i < self.size:
+            raise IndexError(i)
+        start, end = self.OFFSETS.unpack_from(
+            self.map, self.HEADER.size + self.OFFSET.size * i)
+        return self.map[self.data_start + start:self.data_start + end]
+
+def exclude_list_fingerprint(exclude_list, canonicalizer_options):
+    """SHA1 digest of exclude list file content and canonicalizer options,
+    with which its compiled form was made.
+    """
+    h = hashlib.sha1(MappedPrefixList.MAGIC)
+    h.update(repr(sorted(dict(canonicalizer_options).items())))
+    with open(exclude_list, 'rb') as f:
+        for block in iter(lambda: f.read(1024*1024), ''):
+            h.update(block)
+    return h.digest()
+
+def compile_exclude_list(path, prefixes, fingerprint):
+    """Write :class:`PrefixSet` `prefixes` to compiled exclude list file
+    `path`, consisting of a header (magic, fingerprint of the source
+    and the number of prefixes), ``n + 1`` little-endian 64-bit offsets of
+    prefixes, and then the prefixes themselves. File is written to
+    a temporary file first and renamed, so that concurrent processes never
+    see a partially written file.
+    """
+    dirname = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=dirname, prefix='.exclude-cache-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            prefixes = prefixes.prefixes
+            f.write(MappedPrefixList.HEADER.pack(
+                MappedPrefixList.MAGIC, fingerprint, len(prefixes)))
+            pos = 0
+            offsets = [0]
+            for prefix in prefixes:
+                pos += len(prefix)
+                offsets.append(pos)
+            for i in range(0, len(offsets), 65536):
+                batch = offsets[i:i+65536]
+                f.write(struct.pack('<{}Q'.format(len(batch)), *batch))
+            for prefix in prefixes:
+                f.write(prefix)
+        os.chmod(tmp_path, 0o644)
+        os.rename(tmp_path, path)
+    except:
+        os.unlink(tmp_path)
+        raise
+
+class LRUCache(object):
+    """Mapping of at most `maxsize` items, discarding least recently used
+    items first. It counts hits and misses of :meth:`get`.
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.data)
+
+    def get(self, key, default=None):
+        try:
+            value = self.data.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        # re-insert to make it the most recently used
+        self.data[key] = value
+        self.hits += 1
+        return value
+
+    def __setitem__(self, key, value):
+        self.data.pop(key, None)
+        self.data[key] = value
+        if len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+def merge_sorted_lines(files):
+    """Merge iterables of sorted lines into one sorted sequence of lines.
+    Like ``LC_ALL=C sort -m``, lines are compared bytewise without their
+    trailing newline, and the last line of an input gets one if missing.
+    """
+    heap = []
+    for i, f in enumerate(files):
+        it = iter(f)
+        for line in it:
+            heap.append((line[:-1] if line.endswith('\n') else line, i, it))
+            break
+    heapq.heapify(heap)
+    while heap:
+        key, i, it = heap[0]
+        yield key + '\n'
+        for line in it:
+            heapq.heapreplace(heap, (line[:-1] if line.endswith('\n') else line, i, it))
+            break
+        else:
+            heapq.heappop(heap)
+
+class BufferedWriter(object):
+    """File-like object collecting writes to `out_file` in memory, and
+    writing them to `out_file` in blocks of about `buffer_size` bytes.
+    :meth:`flush` writes out buffered data and flushes `out_file`.
+    :meth:`close` flushes, leaving `out_file` open.
+    """
+    def __init__(self, out_file, buffer_size=1024*1024):
+        self.out_file = out_file
+        self.buffer_size = buffer_size
+        self.buffer = []
+        self.size = 0
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.size += len(data)
+        if self.size >= self.buffer_size:
+            self._write_buffer()
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def _write_buffer(self):
+        if self.buffer:
+            self.out_file.write(''.join(self.buffer))
+            del self.buffer[:]
+            self.size = 0
+
+    def flush(self):
+        self._write_buffer()
+        self.out_file.flush()
+
+    def tell(self):
+        return self.out_file.tell() + self.size
+
+    def fileno(self):
+        return self.out_file.fileno()
+
+    def close(self):
+        self.flush()
+
+class SortedLineWriter(object):
+    """File-like object writing lines to `out_file` in ``LC_ALL=C sort``
+    order. Lines are buffered in memory up to about `buffer_size` bytes,
+    then sorted and written to a temporary file (a run). :meth:`close`
+    merges the runs into `out_file`, which is left open.
+    """
+    # approximate memory used by a str and a reference to it in a list,
+    # in addition to its content.
+    LINE_OVERHEAD = 48
+
+    def __init__(self, out_file, buffer_size=256*1024*1024, tmpdir=None):
+        self.out_file = out_file
+        self.buffer_size = buffer_size
+        self.tmpdir = tmpdir
+        self.lines = []
+        self.size = 0
+        self.partial = ''
+        self.runs = []
+
+    def write(self, data):
+        if self.partial:
+            data = self.partial + data
+        lines = data.split('\n')
+        self.partial = lines.pop()
+        self.lines.extend(lines)
+        self.size += len(data) - len(self.partial) + self.LINE_OVERHEAD * len(lines)
+        if self.size >= self.buffer_size:
+            self._write_run()
+
+    def _write_run(self):
+        self.lines.sort()
+        run = tempfile.TemporaryFile(dir=self.tmpdir, prefix='cdx_writer-sort-')
+        run.writelines(line + '\n' for line in self.lines)
+        run.seek(0)
+        self.runs.append(run)
+        self.lines = []
+        self.size = 0
+
+    def close(self):
+        """Write out all lines in sorted order."""
+        if self.partial:
+            self.lines.append(self.partial)
+            self.partial = ''
+        if not self.runs:
+            self.lines.sort()
+            self.out_file.writelines(line + '\n' for line in self.lines)
+            self.lines = []
+            return
+        if self.lines:
+            self._write_run()
+        try:
+            self.out_file.writelines(merge_sorted_lines(self.runs))
+        finally:
+            for run in self.runs:
+                run.close()
+            self.runs = []
+
+class ZipNumWriter(object):
+    """File-like object writing sorted CDX lines to a ZipNum cluster at
+    `path` (``NAME.cdx.gz``): a series of gzip members, each holding
+    `lines_per_block` lines. Alongside it, a summary index ``NAME.idx`` has
+    a line for each block, with the first two fields of its first line,
+    cluster name, offset, length and number of the block (starting from 1)
+    separated by tabs, and ``NAME.loc`` maps cluster name to the file name.
+    The CDX header line is not written.
+    """
+    def __init__(self, path, lines_per_block=3000):
+        self.path = path
+        base = path[:-3] if path.endswith('.gz') else path
+        if base.endswith('.cdx'):
+            base = base[:-4]
+        self.name = os.path.basename(base)
+        self.idx_path = base + '.idx'
+        self.loc_path = base + '.loc'
+        self.lines_per_block = lines_per_block
+        self.out = open(path, 'wb')
+        self.idx = open(self.idx_path, 'wb')
+        self.block = []
+        self.partial = ''
+        self.offset = 0
+        self.num_blocks = 0
+
+    def write(self, data):
+        if self.partial:
+            data = self.partial + data
+        lines = data.split('\n')
+        self.partial = lines.pop()
+        for line in lines:
+            self._add_line(line)
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def _add_line(self, line):
+        if line.startswith(' CDX '):
+            return
+        self.block.append(line)
+        if len(self.block) >= self.lines_per_block:
+            self._write_block()
+
+    def _write_block(self):
+        c = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        data = c.compress(''.join(line + '\n' for line in self.block)) + c.flush()
+        self.out.write(data)
+        self.num_blocks += 1
+        key = ' '.join(self.block[0].split(' ', 2)[:2])
+        self.idx.write('{}\t{}\t{}\t{}\t{}\n'.format(
+            key, self.name, self.offset, len(data), self.num_blocks))
+        self.offset += len(data)
+        self.block = []
+
+    def close(self):
+        if self.partial:
+            self._add_line(self.partial)
+            self.partial = ''
+        if self.block:
+            self._write_block()
+        self.out.close()
+        self.idx.close()
+        with open(self.loc_path, 'wb') as f:
+            f.write('{}\t{}\n'.format(self.name, os.path.basename(self.path)))
+
+class RecordTimer(object):
+    """Measures time spent in pipeline stages and CDX field getters for
+    a record, and adds them up in `timings` by handler class on
+    :meth:`finish`.
+    """
+    def __init__(self, timings, read_time):
+        self.timings = timings
+        self.handler_class = 'unhandled'
+        self.stages = {'read': read_time}
+        self.fields = {}
+        self.last = time.time()
+
+    def set_handler(self, handler):
+        self.handler_class = type(handler).__name__
+
+    def lap(self, stage):
+        """Add time since last lap to `stage`."""
+        now = time.time()
+        self.stages[stage] = self.stages.get(stage, 0) + now - self.last
+        self.last = now
+
+    def get_fields(self, handler, fields):
+        """Return values of `fields`, a list of ``(field code, property
+        name)``, from `handler`, timing each of them.
+        """
+        values = []
+        for code, attr in fields:
+            start = time.time()
+            values.append(getattr(handler, attr))
+            self.fields[code] = self.fields.get(code, 0) + time.time() - start
+        self.lap('fields')
+        return values
+
+    def finish(self):
+        t = self.timings.setdefault(self.handler_class,
+                                    {'records': 0, 'stages': {}, 'fields': {}})
+        t['records'] += 1
+        merge_stats(t['stages'], self.stages)
+        merge_stats(t['fields'], self.fields)
+
+class NullTimer(object):
+    """:class:`RecordTimer` for records not sampled, doing nothing."""
+    def set_handler(self, handler):
+        pass
+
+    def lap(self, stage):
+        pass
+
+    def finish(self):
+        pass
+
+NULL_TIMER = NullTimer()
+
+class Profiler(object):
+    """Collects timings of every `interval`-th record with
+    :class:`RecordTimer`. Timings (in seconds) are in `timings`, keyed by
+    handler class name, with number of records sampled in ``records``,
+    time in each stage in ``stages``, and time in each field in ``fields``.
+    Stages are:
+
+    - ``read``: reading (and decompressing) record header
+    - ``dispatch``: payload parsing and handler construction
+    - ``exclude``: urlkey canonicalization and exclude list lookup
+    - ``fields``: getting CDX field values
+    - ``write``: writing CDX line
+    """
+    def __init__(self, interval):
+        self.interval = interval
+        self.timings = {}
+        self.count = 0
+        self.read_time = 0
+
+    def timed(self, iterable):
+        """Iterate over `iterable`, keeping time taken by the last item in
+        `read_time`.
+        """
+        it = iter(iterable)
+        while True:
+            start = time.time()
+            try:
+                item = next(it)
+            except StopIteration:
+                return
+            self.read_time = time.time() - start
+            yield item
+
+    def record_timer(self):
+        """Return timer for the record just read."""
+        self.count += 1
+        if self.count % self.interval:
+            return NULL_TIMER
+        return RecordTimer(self.timings, self.read_time)
+
 class CDX_Writer(object):
-    def __init__(self, file, out_file=sys.stdout, format="N b a m s k r M S V g", use_full_path=False, file_prefix=None, all_records=False, screenshot_mode=False, exclude_list=None, stats_file=None, canonicalizer_options=None):
+    def __init__(self, file, out_file=sys.stdout, format="N b a m s k r M S V g",
+                 use_full_path=False, file_prefix=None, all_records=False,
+                 screenshot_mode=False, exclude_list=None, stats_file=None,
+                 canonicalizer_options=None,
+                 # input
+                 file_name=None, streaming=False, chunk_size=64*1024,
+                 parallel=1, meta_scan_size=5*1024*1024,
+                 # urlkeys and exclusion
+                 exclude_cache=None, urlkey_cache_size=10000,
+                 # output
+                 output_buffer_size=1024*1024, sort=False,
+                 sort_buffer_size=256*1024*1024, zipnum_lines=None,
+                 # checkpoints
+                 checkpoint_file=None, checkpoint_interval=1000,
+                 # follow mode
+                 follow=False, poll_interval=1.0, idle_timeout=600,
+                 # metrics
+                 timing_interval=0, progress=False, progress_interval=10.0,
+                 prometheus_file=None):
         """This class is instantiated for each web archive file and generates
         CDX from it.
 
-        :param file: input web archive file name
+        :param file: input web archive file name, or a readable stream
+            (``-`` for stdin), such as a pipe. Offsets are counted from
+            the start of the stream. Streams cannot be indexed in parallel,
+            with checkpoints or in follow mode.
         :param out_file: file object to write CDX to
         :param format: CDX field specification string.
         :param use_full_path: if ``True``, use absolute path of `file` for ``g``
@@ -707,6 +2238,55 @@ class CDX_Writer(object):
         :param exclude_list: a file containing a list of excluded URLs
         :param stat_file: a filename to write out statistics.
         :param canonicalizer_options: URL canonicalizer options
+        :param file_name: name of `file` for ``g`` field and statistics
+            when it is a stream [default: ``-``]
+        :param streaming: if ``True``, read record payloads in chunks of
+            `chunk_size` bytes rather than loading them in memory as a whole
+        :param chunk_size: payload read size in streaming mode
+        :param parallel: number of worker processes indexing parts of `file`
+            in parallel. Only gzipped WARC files are split; other files are
+            processed serially.
+        :param meta_scan_size: number of bytes at the start of HTML payload
+            to look for meta tags in (they are looked for only before
+            ``</head>`` or ``<body>``).
+        :param exclude_cache: compiled `exclude_list` file. It is made from
+            `exclude_list` if it does not exist or is out of date, and then
+            loaded with mmap.
+        :param urlkey_cache_size: number of urlkeys to keep in memory for
+            reuse by records with the same URL. ``0`` disables the cache.
+        :param output_buffer_size: number of bytes of CDX lines to collect in
+            memory before writing them to `out_file` (unless sorting).
+            Output is also flushed at checkpoints and at the end.
+        :param sort: if ``True``, output (including header line) is sorted
+            in the same order as ``LC_ALL=C sort``.
+        :param sort_buffer_size: approximate number of bytes of memory to use
+            for sorting. Output exceeding it is sorted in temporary files
+            and merged.
+        :param zipnum_lines: if given, write sorted CDX to a ZipNum cluster
+            with this many lines per block (see :class:`ZipNumWriter`).
+            `out_file` must be a file name.
+        :param checkpoint_file: a JSON file to save progress to every
+            `checkpoint_interval` records. If it exists, indexing resumes
+            from the saved progress, appending to `out_file`, which must be
+            a file name. It is removed when indexing completes. Files are
+            processed serially, and output cannot be sorted.
+        :param checkpoint_interval: number of records between checkpoints
+        :param follow: if ``True``, `file` is a gzipped WARC file still being
+            written. Records are indexed as they are completed, until `file`
+            is renamed or removed (by crawler finishing it), ``SIGTERM`` or
+            ``SIGUSR1`` is received, or no record is added for `idle_timeout`
+            seconds. ``.open`` suffix is removed from file name in ``g``.
+        :param poll_interval: seconds between checks for new records
+        :param idle_timeout: seconds without new records to stop after
+        :param timing_interval: if non-zero, time pipeline stages and fields
+            of every `timing_interval`-th record, and add timings by handler
+            class to stats in ``timings`` (see :class:`Profiler`).
+        :param progress: if ``True``, print progress and ETA to stderr
+            every `progress_interval` seconds.
+        :param progress_interval: seconds between progress updates
+        :param prometheus_file: a filename to write out statistics to in
+            Prometheus text format, for node exporter textfile collector.
+            It is updated every `progress_interval` seconds as well.
         """
         self.field_map = {'M': 'AIF meta tags',
                           'N': 'massaged url',
@@ -721,20 +2301,70 @@ class CDX_Writer(object):
                           's': 'response code',
                          }
 
+        if file == '-':
+            file = sys.stdin
+        if isinstance(file, basestring):
+            self.stream = None
+        else:
+            if checkpoint_file or follow:
+                raise ValueError("checkpoint and follow mode need a file, not a stream")
+            self.stream = file
+            file = file_name or '-'
         self.file   = file
+        # name of the file when finished (crawlers add ".open" while writing)
+        self.file_name = file
+        if follow and file.endswith('.open'):
+            self.file_name = file[:-len('.open')]
         self.out_file = out_file
         self.format = format
 
-        self.fieldgetter = self._build_fieldgetter(self.format.split())
+        self.serialize = self._build_serializer(self.format.split())
+        self.fields = self._field_attrs(self.format.split())
+        # formats not looking into payload are indexed reading record
+        # headers only (see HeaderReader)
+        self.header_only = set(self.format.split()) <= self.header_fields
 
         self.dispatcher = RecordDispatcher(
             all_records=all_records, screenshot_mode=screenshot_mode)
 
         self.canonicalizer_options = canonicalizer_options or {}
+        self.canonicalizer_kwargs = dict(self.canonicalizer_options)
+
+        if urlkey_cache_size > 0:
+            self.urlkey_cache = LRUCache(urlkey_cache_size)
+        else:
+            self.urlkey_cache = None
+
+        self.chunk_size = chunk_size if streaming else None
+
+        self.parallel = parallel
+
+        self.sort = sort
+        self.sort_buffer_size = sort_buffer_size
+        self.zipnum_lines = zipnum_lines
+
+        if checkpoint_file and (self.sort or self.zipnum_lines):
+            raise ValueError("checkpoint cannot be used with sorted output")
+        self.checkpoint_file = checkpoint_file
+        self.checkpoint_interval = checkpoint_interval
+
+        if follow and (self.sort or self.zipnum_lines or checkpoint_file):
+            raise ValueError("follow mode cannot be used with sorted output or checkpoint")
+        self.follow = follow
+        self.poll_interval = poll_interval
+        self.idle_timeout = idle_timeout
+
+        self.timing_interval = timing_interval
+
+        self.progress = progress
+        self.progress_interval = progress_interval
+        self.prometheus_file = prometheus_file
 
         #Large html files cause lxml to segfault
         #problematic file was 154MB, we'll stop at 5MB
         self.lxml_parse_limit = 5 * 1024 * 1024
+        self.meta_scan_size = meta_scan_size
+        self.output_buffer_size = output_buffer_size
 
         if use_full_path:
             self.warc_path = os.path.abspath(file)
@@ -742,44 +2372,115 @@ class CDX_Writer(object):
             self.warc_path = os.path.join(file_prefix, file)
         else:
             self.warc_path = file
+        if follow and self.warc_path.endswith('.open'):
+            self.warc_path = self.warc_path[:-len('.open')]
 
         if exclude_list:
-            if not os.path.exists(exclude_list):
-                raise IOError("Exclude file not found")
-            self.excludes = []
-            with open(exclude_list, 'r') as f:
-                for line in f:
-                    if '' == line.strip():
-                        continue
-                    url = line.split()[0]
-                    self.excludes.append(self.urlkey(url))
+            self.excludes = self.load_exclude_list(exclude_list, exclude_cache)
         else:
             self.excludes = None
 
         if stats_file:
-            if os.path.exists(stats_file):
+            # stats file of an interrupted run is overwritten on resume
+            resuming = checkpoint_file and os.path.exists(checkpoint_file)
+            if os.path.exists(stats_file) and not resuming:
                 raise IOError("Stats file already exists")
             self.stats_file = stats_file
         else:
             self.stats_file = None
 
-    def _build_fieldgetter(self, fieldcodes):
-        """Return a callable that collects CDX field values from a
-        :class:`RecordHandler` object, according to CDX field specification
-        `fieldcodes`.
+    # fields computed from record headers alone
+    header_fields = set('N b a r S V g'.split())
+
+    def _field_attrs(self, fieldcodes):
+        """Return a list of ``(field code, property name)`` for getting
+        CDX field values from a :class:`RecordHandler` object, according to
+        CDX field specification `fieldcodes`.
 
         :param fieldcodes: a list of single-letter CDX field codes.
         """
-        attrs = []
+        fields = []
         for field in fieldcodes:
             if field not in self.field_map:
                 raise ParseError('unknown field; {}'.format(field))
-            attrs.append(self.field_map[field].replace(' ', '_').lower())
-        return attrgetter(*attrs)
+            fields.append((field, self.field_map[field].replace(' ', '_').lower()))
+        return fields
+
+    def _build_serializer(self, fieldcodes):
+        """Return a function making a CDX line, with line terminator, from
+        a :class:`RecordHandler` object, according to CDX field
+        specification `fieldcodes`. Attribute getters for the format are
+        made once, so that for each record it only gets the field values
+        and joins them into the line, with ``-`` for ``None``.
+
+        :param fieldcodes: a list of single-letter CDX field codes.
+        """
+        getters = tuple(operator.attrgetter(attr)
+                        for code, attr in self._field_attrs(fieldcodes))
+
+        def serialize(handler):
+            values = [getter(handler) for getter in getters]
+            return ' '.join(['-' if v is None else v for v in values]) + '\n'
+        return serialize
+
+    # exclude lists already loaded in this process, so that batch mode
+    # workers load each list only once (see make_cdx_batch()).
+    _exclude_list_cache = {}
+
+    def load_exclude_list(self, exclude_list, exclude_cache=None):
+        """Return a :class:`PrefixSet` of urlkeys read from file `exclude_list`,
+        or from compiled exclude list file `exclude_cache`.
+        """
+        if not os.path.exists(exclude_list):
+            raise IOError("Exclude file not found")
+        st = os.stat(exclude_list)
+        cache_key = (os.path.abspath(exclude_list), st.st_mtime, st.st_size,
+                     tuple(sorted(dict(self.canonicalizer_options).items())),
+                     exclude_cache and os.path.abspath(exclude_cache))
+        excludes = self._exclude_list_cache.get(cache_key)
+        if excludes is None and exclude_cache:
+            fingerprint = exclude_list_fingerprint(
+                exclude_list, self.canonicalizer_options)
+            if os.path.exists(exclude_cache):
+                try:
+                    prefixes = MappedPrefixList(exclude_cache)
+                except (ValueError, EnvironmentError):
+                    # unreadable cache is rebuilt, as a stale one
+                    prefixes = None
+                if prefixes is not None and prefixes.fingerprint == fingerprint:
+                    excludes = PrefixSet.from_sorted(prefixes)
+            if excludes is None:
+                excludes = self.load_exclude_list(exclude_list)
+                compile_exclude_list(exclude_cache, excludes, fingerprint)
+                excludes = PrefixSet.from_sorted(MappedPrefixList(exclude_cache))
+            self._exclude_list_cache[cache_key] = excludes
+        if excludes is None:
+            excludes = []
+            with open(exclude_list, 'r') as f:
+                for line in f:
+                    if '' == line.strip():
+                        continue
+                    url = line.split()[0]
+                    excludes.append(self.canonicalize(url))
+            excludes = PrefixSet(excludes)
+            self._exclude_list_cache[cache_key] = excludes
+        return excludes
+
+    def canonicalize(self, url):
+        """compute urlkey from `url`, bypassing urlkey cache."""
+        return surt(url, **self.canonicalizer_kwargs)
 
     def urlkey(self, url):
         """compute urlkey from `url`."""
-        return surt(url, **dict(self.canonicalizer_options))
+        # unicode URLs (screenshot mode) are rare, and would collide
+        # with byte string URLs in cache.
+        if self.urlkey_cache is None or not isinstance(url, str):
+            return surt(url, **self.canonicalizer_kwargs)
+        key = self.urlkey_cache.get(url)
+        if key is None:
+            key = surt(url, **self.canonicalizer_kwargs)
+            self.urlkey_cache[url] = key
+        return key
 
     # should_exclude()
     #___________________________________________________________________________
@@ -787,59 +2488,429 @@ class CDX_Writer(object):
         if not self.excludes:
             return False
 
-        for prefix in self.excludes:
-            if surt_url.startswith(prefix):
-                return True
-
-        return False
+        return self.excludes.match(surt_url)
 
 
     # make_cdx()
     #___________________________________________________________________________
     def make_cdx(self):
+        checkpoint = None
+        if self.checkpoint_file:
+            if not isinstance(self.out_file, basestring):
+                raise ValueError("checkpoint needs an output file name")
+            checkpoint = self.load_checkpoint()
+
         close_out_file = False
-        if isinstance(self.out_file, basestring):
+        if checkpoint is not None:
+            # drop output written after the checkpoint
+            self.out_file = open(self.out_file, 'r+b')
+            self.out_file.truncate(checkpoint['output_size'])
+            self.out_file.seek(0, os.SEEK_END)
+            close_out_file = True
+        elif self.zipnum_lines:
+            if not isinstance(self.out_file, basestring):
+                raise ValueError("ZipNum output needs an output file name")
+            self.out_file = ZipNumWriter(self.out_file, self.zipnum_lines)
+            close_out_file = True
+        elif isinstance(self.out_file, basestring):
             self.out_file = open(self.out_file, 'wb')
             close_out_file = True
 
-        stats = {
-            'num_records_processed': 0,
-            'num_records_included': 0,
-            'num_records_filtered': 0,
-            }
+        stats = self.new_stats()
+        if checkpoint is not None:
+            stats.update(checkpoint['stats'])
+        out_file = self.out_file
+        self.started = (time.time(), cpu_time())
         try:
-            self._make_cdx(stats)
+            if self.sort or self.zipnum_lines:
+                self.out_file = SortedLineWriter(out_file, self.sort_buffer_size)
+            else:
+                self.out_file = BufferedWriter(out_file, self.output_buffer_size)
+            if checkpoint is not None:
+                self._resume_cdx(stats, checkpoint['offset'])
+            else:
+                self._make_cdx(stats)
+            self.out_file.close()
+            if self.checkpoint_file and os.path.exists(self.checkpoint_file):
+                os.unlink(self.checkpoint_file)
         finally:
+            if isinstance(self.out_file, BufferedWriter):
+                # keep output written before an error
+                self.out_file.flush()
+            self.out_file = out_file
             if close_out_file:
                 self.out_file.close()
 
-            if self.stats_file is not None:
-                with open(self.stats_file, 'w') as f:
-                    json.dump(stats, f, indent=4)
+            update_run_times(stats, *self.started)
+            if self.prometheus_file is not None:
+                write_prometheus_textfile(self.prometheus_file, stats,
+                                          {'file': self.file_name})
+        # not written on errors, which would stop a run from being restarted
+        if self.stats_file is not None:
+            with open(self.stats_file, 'w') as f:
+                json.dump(stats, f, indent=4)
+        return stats
+
+    def new_stats(self):
+        return {
+            'num_records_processed': 0,
+            'num_records_included': 0,
+            'num_records_filtered': 0,
+            'urlkey_cache_hits': 0,
+            'urlkey_cache_misses': 0,
+            'bytes_compressed': 0,
+            'bytes_uncompressed': 0,
+            'records_by_type': {},
+            'records_by_handler': {},
+            'records_skipped': {},
+            'wall_time': 0.0,
+            'cpu_time': 0.0,
+            }
+
+    def report_progress(self, stats, done, total, elapsed):
+        """Print progress of `done` bytes out of `total` (``None`` if
+        unknown) in `elapsed` seconds, and update Prometheus textfile.
+        """
+        if self.progress:
+            if total is None:
+                # stream of unknown size
+                position = '{} bytes'.format(done)
+                eta = '-'
+            else:
+                position = '{:.1f}% ({} of {} bytes)'.format(
+                    100.0 * done / max(total, 1), done, total)
+                if done > 0:
+                    eta = '{:.0f}s'.format(elapsed * (total - done) / done)
+                else:
+                    eta = '-'
+            elapsed = max(elapsed, 1e-6)
+            sys.stderr.write(
+                '{}: {}, {} records, {:.0f} records/s,'
+                ' {:.1f} MB/s, ETA {}\n'.format(
+                    self.file, position,
+                    stats['num_records_processed'],
+                    stats['num_records_processed'] / elapsed,
+                    done / (1024.0 * 1024) / elapsed, eta))
+        if self.prometheus_file is not None:
+            snapshot = dict(stats)
+            update_run_times(snapshot, *self.started)
+            write_prometheus_textfile(self.prometheus_file, snapshot,
+                                      {'file': self.file_name})
 
     def _make_cdx(self, stats):
         self.out_file.write(b' CDX ' + self.format + b'\n') #print header
 
-        fh = ArchiveRecord.open_archive(self.file, gzip="auto", mode="r")
-        for (offset, record, errors) in fh.read_records(limit=None, offsets=True):
+        if self.follow:
+            self._follow_cdx(stats)
+            return
+
+        ranges = None
+        if self.parallel > 1 and not self.checkpoint_file and self.stream is None:
+            ranges = self.split_ranges(self.parallel)
+        if ranges:
+            self._make_cdx_parallel(ranges, stats)
+        else:
+            self._make_cdx_range(stats)
+
+    def _follow_cdx(self, stats):
+        """Write CDX lines for records in gzip members completed so far,
+        and repeat every `poll_interval` seconds until told to stop.
+        A final pass is made after the stop condition.
+        """
+        stop = []
+        def request_stop(signum, frame):
+            stop.append(signum)
+        saved_handlers = {}
+        for signum in (signal.SIGTERM, signal.SIGUSR1):
+            saved_handlers[signum] = signal.signal(signum, request_stop)
+
+        fh = open(self.file, 'rb')
+        st = os.fstat(fh.fileno())
+        scanner = MemberScanner(fh)
+        pos = 0
+        # start of the first record, once complete
+        head = ''
+        last_growth = time.time()
+        try:
+            while True:
+                finished = bool(stop) or not self._is_same_file(st)
+                size = os.fstat(fh.fileno()).st_size
+                if pos == 0 and size >= 2:
+                    fh.seek(0)
+                    if fh.read(2) != GZIP_MAGIC[:2]:
+                        raise ValueError("{}: follow mode needs a gzipped WARC "
+                                         "file".format(self.file))
+                end = scanner.scan(size)
+                if not head and end > 0:
+                    # ARC files have fields defined in the first record,
+                    # which later ranges would not see
+                    head = self._first_record_head(fh, end)
+                    if head and not head.startswith('WARC/'):
+                        raise ValueError("{}: follow mode needs a gzipped "
+                                         "WARC file".format(self.file))
+                if end > pos:
+                    self._make_cdx_range(stats, pos, end, source=fh)
+                    self.out_file.flush()
+                    pos = end
+                    last_growth = time.time()
+                if finished or time.time() - last_growth >= self.idle_timeout:
+                    break
+                time.sleep(self.poll_interval)
+        finally:
+            fh.close()
+            for signum, handler in saved_handlers.iteritems():
+                signal.signal(signum, handler)
+
+    def _first_record_head(self, fh, end):
+        """Return the first bytes of the first record in gzip members of
+        `fh` before `end`, or ``''`` if there's none.
+        """
+        head_complete = lambda head: len(head.lstrip()) >= 5
+        for _, _, head, _ in gzip_members(FileRange(fh, 0, end), 64*1024,
+                                          head_complete):
+            if head.lstrip():
+                return head.lstrip()
+        return ''
+
+    def _is_same_file(self, st):
+        """Return ``True`` if `file` is still the file of stat `st`."""
+        try:
+            path_st = os.stat(self.file)
+        except OSError:
+            return False
+        return (path_st.st_dev, path_st.st_ino) == (st.st_dev, st.st_ino)
+
+    def _resume_cdx(self, stats, offset):
+        """Continue writing CDX lines from the record at `offset`. Gzipped
+        WARC file is read from `offset`; other files are read from the start,
+        skipping records before it (ARC records depend on the header
+        record at the start of file).
+        """
+        size = os.path.getsize(self.file)
+        with open(self.file, 'rb') as fh:
+            seekable = find_warc_member(fh, offset, offset + 1) == offset
+        if seekable:
+            self._make_cdx_range(stats, offset, size)
+        else:
+            self._make_cdx_range(stats, skip_to=offset)
+
+    def load_checkpoint(self):
+        """Return checkpoint saved in `checkpoint_file` for this input file
+        and format, or ``None`` if there's no checkpoint.
+        """
+        if not os.path.exists(self.checkpoint_file):
+            return None
+        with open(self.checkpoint_file) as f:
+            checkpoint = json.load(f)
+        if (checkpoint['file'] != os.path.abspath(self.file) or
+            checkpoint['file_size'] != os.path.getsize(self.file) or
+            checkpoint['format'] != self.format):
+            raise ValueError("{}: checkpoint is for a different input file or "
+                             "format".format(self.checkpoint_file))
+        return checkpoint
+
+    def save_checkpoint(self, offset, stats):
+        """Save checkpoint with records up to `offset` written to output.
+        Output is flushed to disk first, and the checkpoint file is replaced
+        atomically.
+        """
+        self.out_file.flush()
+        os.fsync(self.out_file.fileno())
+        checkpoint = {
+            'file': os.path.abspath(self.file),
+            'file_size': os.path.getsize(self.file),
+            'format': self.format,
+            'offset': offset,
+            'output_size': self.out_file.tell(),
+            'stats': stats,
+            }
+        tmp_path = self.checkpoint_file + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(checkpoint, f, indent=4)
+        os.rename(tmp_path, self.checkpoint_file)
+
+    def split_ranges(self, n):
+        """Split gzipped WARC file into at most `n` contiguous ranges of
+        whole gzip members, of roughly equal size. Return a list of
+        ``(start, end)``, or ``None`` if file is not a gzipped WARC.
+        """
+        size = os.path.getsize(self.file)
+        with open(self.file, 'rb') as fh:
+            if find_warc_member(fh, 0, 1) != 0:
+                return None
+            starts = [0]
+            for i in range(1, n):
+                pos = find_warc_member(fh, max(starts[-1] + 1, size * i // n), size)
+                if pos is None:
+                    break
+                if pos > starts[-1]:
+                    starts.append(pos)
+        return zip(starts, starts[1:] + [size])
+
+    def _make_cdx_parallel(self, ranges, stats):
+        """Index `ranges` of the file in worker processes, each writing CDX
+        lines to a temporary file, and concatenate them in offset order.
+        """
+        global _range_cdx_writer
+        tmpdir = tempfile.mkdtemp(prefix='cdx_writer-')
+        # forked workers inherit this CDX_Writer
+        _range_cdx_writer = self
+        pool = multiprocessing.Pool(min(self.parallel, len(ranges)))
+        try:
+            tasks = [(start, end, os.path.join(tmpdir, '{}.cdx'.format(start)))
+                     for start, end in ranges]
+            for (start, end, out_path), range_stats in zip(
+                    tasks, pool.imap(_make_cdx_range_worker, tasks)):
+                merge_stats(stats, range_stats)
+                with open(out_path, 'rb') as f:
+                    shutil.copyfileobj(f, self.out_file)
+                os.unlink(out_path)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+            _range_cdx_writer = None
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+    # in streaming mode, records larger than this (uncompressed) are
+    # streamed rather than held in memory
+    max_member_size = 1024*1024
+
+    def open_reader(self, fh, gzipped):
+        """Return a record reader of W/ARC file `fh`, a real file or
+        :class:`StreamFile`. Uncompressed real files are memory-mapped;
+        streams are read sequentially, through a :class:`SpoolFile` if
+        gzip members may be decompressed again.
+        """
+        if (isinstance(fh, StreamFile) and gzipped and
+                (self.header_only or self.chunk_size is not None)):
+            fh = SpoolFile(fh, self.max_member_size)
+        if self.header_only:
+            return HeaderReader(fh)
+        elif gzipped:
+            if self.chunk_size is None:
+                return GzipMemberReader(fh)
+            else:
+                return GzipMemberReader(fh, max_member_size=self.max_member_size)
+        elif isinstance(fh, StreamFile):
+            if self.chunk_size is None:
+                return StreamReader(fh)
+            else:
+                return StreamReader(fh, max_block_size=self.max_member_size)
+        else:
+            return MappedReader(fh)
+
+    def _make_cdx_range(self, stats, start=0, end=None, skip_to=0, source=None):
+        """Write CDX lines for records in bytes `start` to `end` of the file
+        (whole file if `end` is ``None``). `start` and `end` must be record
+        boundaries. Records before offset `skip_to` are read, but ignored.
+        If given, open file `source` is read instead of opening the file
+        (`end` is required).
+        """
+        cache = self.urlkey_cache
+        if cache is not None:
+            # lookups already counted in stats
+            counted = {'hits': cache.hits, 'misses': cache.misses}
+
+        if end is None:
+            if self.stream is not None:
+                raw = StreamFile(self.stream)
+            else:
+                raw = open(self.file, 'rb')
+            gzipped = raw.read(2) == GZIP_MAGIC[:2]
+            raw.seek(0)
+            fh = self.open_reader(raw, gzipped)
+        else:
+            # ranges are in gzipped files
+            if source is None:
+                raw = open(self.file, 'rb')
+            else:
+                raw = os.fdopen(os.dup(source.fileno()), 'rb')
+            fh = self.open_reader(FileRange(raw, start, end), True)
+        profiler = Profiler(self.timing_interval) if self.timing_interval else None
+
+        def merge_counters():
+            # counters kept outside stats are merged before checkpoints
+            # and at the end
+            if profiler is not None:
+                merge_stats(stats.setdefault('timings', {}), profiler.timings)
+                profiler.timings = {}
+            if cache is not None:
+                stats['urlkey_cache_hits'] += cache.hits - counted['hits']
+                stats['urlkey_cache_misses'] += cache.misses - counted['misses']
+                counted.update(hits=cache.hits, misses=cache.misses)
+
+        records = fh.read_records(limit=None, offsets=True)
+        if profiler is not None:
+            records = profiler.timed(records)
+        timer = NULL_TIMER
+
+        report = self.progress or self.prometheus_file is not None
+        if report:
+            if end is not None:
+                range_size = end - start
+            elif self.stream is None:
+                range_size = os.path.getsize(self.file) - start
+            else:
+                # unknown
+                range_size = None
+            range_started = time.time()
+            next_report = range_started + self.progress_interval
+
+        since_checkpoint = 0
+        for (offset, record, errors) in records:
+            timer.finish()
+            timer = NULL_TIMER
+            offset += start
             if not record:
                 if errors:
                     raise ParseError(str(errors))
                 continue # tail
+            if offset < skip_to:
+                continue
+
+            if self.checkpoint_file:
+                if since_checkpoint >= self.checkpoint_interval:
+                    merge_counters()
+                    self.save_checkpoint(offset, stats)
+                    since_checkpoint = 0
+                since_checkpoint += 1
 
             stats['num_records_processed'] += 1
-            handler = self.dispatcher.get_handler(record, offset=offset, cdx_writer=self)
+            if report and time.time() >= next_report:
+                self.report_progress(stats, offset - start, range_size,
+                                     time.time() - range_started)
+                next_report = time.time() + self.progress_interval
+            if profiler is not None:
+                timer = profiler.record_timer()
+
+            stats['bytes_compressed'] += record.compressed_record_size or 0
+            content_length_str = record.get_header(record.CONTENT_LENGTH)
+            if content_length_str is not None and content_length_str.isdigit():
+                stats['bytes_uncompressed'] += int(content_length_str)
+            count_stat(stats['records_by_type'], record.type)
+
+            payload = RecordPayload(record, self.chunk_size)
+            handler = self.dispatcher.get_handler(record, payload, offset=offset, cdx_writer=self)
+            timer.lap('dispatch')
             if not handler:
+                count_stat(stats['records_skipped'], self.dispatcher.skip_reason)
                 continue
+            timer.set_handler(handler)
+            count_stat(stats['records_by_handler'], type(handler).__name__)
 
             ### arc files from the live web proxy can have a negative content length and a missing payload
             ### check the content_length from the arc header, not the computed payload size returned by record.content_length
-            content_length_str = record.get_header(record.CONTENT_LENGTH)
             if content_length_str is not None and int(content_length_str) < 0:
+                count_stat(stats['records_skipped'], 'negative_length')
                 continue
 
             surt = handler.massaged_url
-            if self.should_exclude(surt):
+            excluded = self.should_exclude(surt)
+            timer.lap('exclude')
+            if excluded:
                 stats['num_records_filtered'] += 1
                 continue
 
@@ -847,43 +2918,473 @@ class CDX_Writer(object):
             # self.headers, self.content = self.parse_headers_and_content(record)
             # self.mime_type             = self.get_mime_type(record, use_precalculated_value=False)
 
-            values = [b'-' if v is None else v for v in self.fieldgetter(handler)]
-            self.out_file.write(b' '.join(values) + b'\n')
+            if timer is NULL_TIMER:
+                self.out_file.write(self.serialize(handler))
+            else:
+                values = timer.get_fields(handler, self.fields)
+                values = [b'-' if v is None else v for v in values]
+                self.out_file.write(b' '.join(values) + b'\n')
+            timer.lap('write')
             #record.dump()
             stats['num_records_included'] += 1
 
+        timer.finish()
         fh.close()
+        merge_counters()
+
+_range_cdx_writer = None
+
+def _make_cdx_range_worker(args):
+    start, end, out_path = args
+    cdx_writer = _range_cdx_writer
+    stats = cdx_writer.new_stats()
+    # parent process writes Prometheus textfile of the whole file
+    cdx_writer.prometheus_file = None
+    out_file = open(out_path, 'wb')
+    cdx_writer.out_file = BufferedWriter(out_file, cdx_writer.output_buffer_size)
+    try:
+        cdx_writer._make_cdx_range(stats, start, end)
+        cdx_writer.out_file.close()
+    finally:
+        out_file.close()
+    return stats
+
+# statistics
+#_______________________________________________________________________________
+def count_stat(counts, key):
+    counts[key] = counts.get(key, 0) + 1
+
+def cpu_time():
+    """Return CPU time (user and system) of this process and its finished
+    child processes.
+    """
+    t = os.times()
+    return t[0] + t[1] + t[2] + t[3]
+
+def update_run_times(stats, wall_start, cpu_start):
+    """Add wall clock and CPU time since `wall_start` and `cpu_start` to
+    `stats`, and set throughput from them.
+    """
+    stats['wall_time'] = stats.get('wall_time', 0) + time.time() - wall_start
+    stats['cpu_time'] = stats.get('cpu_time', 0) + cpu_time() - cpu_start
+    set_rates(stats)
+
+def set_rates(stats):
+    wall_time = stats.get('wall_time')
+    if wall_time:
+        stats['records_per_second'] = stats['num_records_processed'] / wall_time
+        stats['mb_per_second'] = (
+            stats.get('bytes_compressed', 0) / (1024.0 * 1024) / wall_time)
+
+PROMETHEUS_METRICS = [
+    # (name, type, stats key, help)
+    ('records_processed_total', 'counter', 'num_records_processed',
+     'Records read from web archive files.'),
+    ('records_included_total', 'counter', 'num_records_included',
+     'Records written to CDX.'),
+    ('records_filtered_total', 'counter', 'num_records_filtered',
+     'Records excluded by exclude list.'),
+    ('files_processed_total', 'counter', 'num_files_processed',
+     'Web archive files indexed.'),
+    ('files_failed_total', 'counter', 'num_files_failed',
+     'Web archive files failed to index.'),
+    ('bytes_compressed_total', 'counter', 'bytes_compressed',
+     'Bytes of (compressed) records read.'),
+    ('bytes_uncompressed_total', 'counter', 'bytes_uncompressed',
+     'Bytes of record content read, uncompressed.'),
+    ('records_by_type_total', 'counter', 'records_by_type',
+     'Records read by record type.'),
+    ('records_by_handler_total', 'counter', 'records_by_handler',
+     'Records handled by handler class.'),
+    ('records_skipped_total', 'counter', 'records_skipped',
+     'Records not indexed by reason.'),
+    ('wall_seconds', 'gauge', 'wall_time',
+     'Wall clock time of the run.'),
+    ('cpu_seconds', 'gauge', 'cpu_time',
+     'CPU time of the run.'),
+    ('records_per_second', 'gauge', 'records_per_second',
+     'Records read per second.'),
+    ('megabytes_per_second', 'gauge', 'mb_per_second',
+     'Megabytes of records read per second.'),
+    ]
+
+PROMETHEUS_LABELS = {
+    'records_by_type': 'type',
+    'records_by_handler': 'handler',
+    'records_skipped': 'reason',
+    }
+
+def write_prometheus_textfile(path, stats, labels):
+    """Write `stats` to file `path` in Prometheus text format, with `labels`
+    on all metrics. File is replaced atomically, as node exporter may read
+    it at any time.
+    """
+    def format_labels(labels):
+        if not labels:
+            return ''
+        return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\')
+                                               .replace('"', '\\"').replace('\n', '\\n'))
+                              for k, v in sorted(labels.items())) + '}'
+    lines = []
+    for name, mtype, key, help in PROMETHEUS_METRICS:
+        if key not in stats:
+            continue
+        name = 'cdx_writer_' + name
+        lines.append('# HELP {} {}\n'.format(name, help))
+        lines.append('# TYPE {} {}\n'.format(name, mtype))
+        value = stats[key]
+        if isinstance(value, dict):
+            for label_value, count in sorted(value.items()):
+                metric_labels = dict(labels)
+                metric_labels[PROMETHEUS_LABELS[key]] = label_value
+                lines.append('{}{} {}\n'.format(name, format_labels(metric_labels), count))
+        else:
+            lines.append('{}{} {}\n'.format(name, format_labels(labels), value))
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.writelines(lines)
+    os.rename(tmp_path, path)
+
+# make_cdx_batch()
+#_______________________________________________________________________________
+def merge_stats(total, stats):
+    """Add up statistics `stats` into `total`. Nested dicts are merged
+    recursively.
+    """
+    for k, v in stats.iteritems():
+        if isinstance(v, dict):
+            merge_stats(total.setdefault(k, {}), v)
+        elif isinstance(v, (int, long, float)):
+            total[k] = total.get(k, 0) + v
+        else:
+            total[k] = v
+    return total
+
+def _make_cdx_batch_worker(args):
+    file, out_path, writer_options = args
+    try:
+        cdx_writer = CDX_Writer(file, out_path, **writer_options)
+        return file, cdx_writer.make_cdx(), None
+    except Exception as ex:
+        return file, None, '{}: {}'.format(type(ex).__name__, ex)
+
+def make_cdx_batch(files, out_file=sys.stdout, output_dir=None, jobs=None,
+                   stats_file=None, **writer_options):
+    """Generate CDX for many web archive files with a pool of `jobs` worker
+    processes. Exclude list is loaded once, before workers are started.
+
+    :param files: iterable of input web archive file names
+    :param out_file: file object to write combined CDX to, used
+        when `output_dir` is ``None``. Combined CDX has just one header line,
+        and records are in the order of `files`.
+    :param output_dir: if given, CDX for each input file is written to
+        a file in this directory, named after the input file plus ``.cdx``
+        (``.cdx.gz`` for ZipNum output). ZipNum output requires `output_dir`.
+    :param jobs: number of worker processes (defaults to number of CPUs)
+    :param stats_file: a filename to write out statistics summed up across
+        all files.
+    :param writer_options: other keyword arguments for :class:`CDX_Writer`.
+        With ``sort=True``, combined CDX is a merge of sorted CDX of all files.
+    :return: statistics, with number of failed files in ``num_files_failed``
+    """
+    if stats_file is not None and os.path.exists(stats_file):
+        raise IOError("Stats file already exists")
+    if writer_options.get('zipnum_lines') and output_dir is None:
+        raise ValueError("ZipNum output needs output_dir")
+    files = list(files)
+    started = time.time()
+    # workers would overwrite each other's, write totals instead
+    prometheus_file = writer_options.pop('prometheus_file', None)
+
+    exclude_list = writer_options.get('exclude_list')
+    if exclude_list:
+        # load it in this process, so that forked workers inherit it
+        CDX_Writer(os.devnull, exclude_list=exclude_list,
+                   canonicalizer_options=writer_options.get('canonicalizer_options'),
+                   exclude_cache=writer_options.get('exclude_cache'))
+
+    sort = writer_options.get('sort')
+    sorted_paths = []
+    tmpdir = None
+    if output_dir is None:
+        tmpdir = tempfile.mkdtemp(prefix='cdx_writer-')
+        out_paths = [os.path.join(tmpdir, '{}.cdx'.format(i)) for i in range(len(files))]
+    else:
+        ext = '.cdx.gz' if writer_options.get('zipnum_lines') else '.cdx'
+        out_paths = [os.path.join(output_dir, os.path.basename(file) + ext)
+                     for file in files]
+
+    total = {
+        'num_files_processed': 0,
+        'num_files_failed': 0,
+        'num_records_processed': 0,
+        'num_records_included': 0,
+        'num_records_filtered': 0,
+        }
+    pool = multiprocessing.Pool(jobs)
+    try:
+        tasks = [(file, out_path, writer_options)
+                 for file, out_path in zip(files, out_paths)]
+        header_written = False
+        for (file, stats, error), out_path in zip(
+                pool.imap(_make_cdx_batch_worker, tasks), out_paths):
+            if error is not None:
+                sys.stderr.write('{}: {}\n'.format(file, error))
+                total['num_files_failed'] += 1
+                continue
+            total['num_files_processed'] += 1
+            merge_stats(total, stats)
+            if tmpdir is not None and sort:
+                sorted_paths.append(out_path)
+            elif tmpdir is not None:
+                with open(out_path, 'rb') as f:
+                    header = f.readline()
+                    if not header_written:
+                        out_file.write(header)
+                        header_written = True
+                    shutil.copyfileobj(f, out_file)
+                os.unlink(out_path)
+        pool.close()
+        if sorted_paths:
+            merge_cdx(sorted_paths, out_file)
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        if tmpdir is not None:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+    # times are summed up across files, but wall clock time is of the batch
+    total['wall_time'] = time.time() - started
+    set_rates(total)
+    if stats_file is not None:
+        with open(stats_file, 'w') as f:
+            json.dump(total, f, indent=4)
+    if prometheus_file is not None:
+        write_prometheus_textfile(prometheus_file, total, {})
+    return total
+
+# merge_cdx()
+#_______________________________________________________________________________
+def open_cdx(path):
+    """Open CDX file `path` for reading, either plain or gzipped."""
+    f = open(path, 'rb')
+    magic = f.read(len(GZIP_MAGIC))
+    f.seek(0)
+    if magic == GZIP_MAGIC:
+        return gzip.GzipFile(fileobj=f, mode='rb')
+    return f
+
+def unique_lines(lines):
+    """Drop lines equal to their preceding line."""
+    prev = None
+    for line in lines:
+        if line != prev:
+            yield line
+            prev = line
+
+def _merge_cdx_files(paths, out_file, unique):
+    files = []
+    try:
+        header = None
+        inputs = []
+        for path in paths:
+            f = open_cdx(path)
+            files.append(f)
+            first = f.readline()
+            if first.startswith(' CDX '):
+                if not first.endswith('\n'):
+                    first += '\n'
+                if header is None:
+                    header = first
+                elif first != header:
+                    raise ValueError('{}: CDX header {!r} differs from {!r}'.format(
+                        path, first.rstrip('\n'), header.rstrip('\n')))
+                inputs.append(f)
+            elif first:
+                inputs.append(itertools.chain([first], f))
+        if header is not None:
+            out_file.write(header)
+        lines = merge_sorted_lines(inputs)
+        if unique:
+            lines = unique_lines(lines)
+        out_file.writelines(lines)
+    finally:
+        for f in files:
+            f.close()
+
+def merge_cdx(paths, out_file=sys.stdout, unique=False, max_open_files=256,
+              tmpdir=None):
+    """Merge sorted CDX files into one sorted CDX, with a single header line.
+
+    :param paths: CDX file names. Files may be gzipped.
+    :param out_file: file object to write merged CDX to
+    :param unique: if ``True``, drop duplicate lines
+    :param max_open_files: maximum number of files merged at once. If there
+        are more `paths`, groups of them are merged into temporary files
+        first, which are then merged in turn.
+    :param tmpdir: directory for temporary files
+    """
+    paths = list(paths)
+    if max_open_files < 2:
+        raise ValueError('max_open_files must be 2 or more')
+    tmp_paths = []
+    try:
+        while len(paths) > max_open_files:
+            group, paths = paths[:max_open_files], paths[max_open_files:]
+            fd, tmp_path = tempfile.mkstemp(dir=tmpdir, prefix='cdx_writer-merge-')
+            tmp_paths.append(tmp_path)
+            with os.fdopen(fd, 'wb') as f:
+                _merge_cdx_files(group, f, unique)
+            paths.append(tmp_path)
+        _merge_cdx_files(paths, out_file, unique)
+    finally:
+        for tmp_path in tmp_paths:
+            os.unlink(tmp_path)
+
+def merge_main(args):
+    parser = OptionParser(usage="%prog merge [options] cdx[.gz] ...")
+    parser.set_defaults(output         = None,
+                        unique         = False,
+                        max_open_files = 256
+                       )
+    parser.add_option("-o", "--output", dest="output", help="Write merged CDX to this file instead of stdout")
+    parser.add_option("-u", "--unique", dest="unique", action="store_true", help="Drop duplicate lines")
+    parser.add_option("--max-open-files", dest="max_open_files", type="int", help="Maximum number of files to merge at once. More files are merged in multiple passes via temporary files [default: %default]")
+
+    options, input_files = parser.parse_args(args=args)
+    if not input_files or input_files == ['-']:
+        input_files = [line.strip() for line in sys.stdin if line.strip()]
+
+    if options.output:
+        with open(options.output, 'wb') as out_file:
+            merge_cdx(input_files, out_file, options.unique, options.max_open_files)
+    else:
+        merge_cdx(input_files, sys.stdout, options.unique, options.max_open_files)
+    return 0
 
 # main()
 #_______________________________________________________________________________
 def main(args):
 
-    parser = OptionParser(usage="%prog [options] warc.gz [output_file.cdx]")
+    parser = OptionParser(usage="%prog [options] warc.gz|- [output_file.cdx]\n"
+                          "       %prog --batch [options] [warc.gz ...]")
     parser.set_defaults(format        = "N b a m s k r M S V g",
                         use_full_path = False,
                         file_prefix   = None,
                         all_records   = False,
                         screenshot_mode = False,
                         exclude_list    = None,
-                        canonicalizer_options = []
+                        exclude_cache   = None,
+                        urlkey_cache_size = 10000,
+                        canonicalizer_options = [],
+                        streaming       = False,
+                        chunk_size      = 64*1024,
+                        batch           = False,
+                        jobs            = None,
+                        output_dir      = None,
+                        parallel        = 1,
+                        sort            = False,
+                        sort_buffer_size = 256,
+                        zipnum          = False,
+                        zipnum_lines    = 3000,
+                        checkpoint      = None,
+                        checkpoint_interval = 1000,
+                        follow          = False,
+                        poll_interval   = 1.0,
+                        idle_timeout    = 600,
+                        timing_interval = 0,
+                        progress        = False,
+                        progress_interval = 10.0,
+                        prometheus_file = None,
+                        meta_scan_size  = 5*1024*1024,
+                        output_buffer_size = 1024*1024,
+                        file_name       = None
                        )
 
     parser.add_option("--format",  dest="format", help="A space-separated list of fields [default: '%default']")
     parser.add_option("--use-full-path", dest="use_full_path", action="store_true", help="Use the full path of the warc file in the 'g' field")
+    parser.add_option("--file-name", dest="file_name", help="Name of the W/ARC file in the 'g' field when it is read from stdin ('-') [default: '-']")
     parser.add_option("--file-prefix",   dest="file_prefix", help="Path prefix for warc file name in the 'g' field."
                       " Useful if you are going to relocate the warc.gz file after processing it."
                      )
     parser.add_option("--all-records",   dest="all_records", action="store_true", help="By default we only index http responses. Use this flag to index all WARC records in the file")
     parser.add_option("--screenshot-mode", dest="screenshot_mode", action="store_true", help="Special Wayback Machine mode for handling WARCs containing screenshots")
     parser.add_option("--exclude-list", dest="exclude_list", help="File containing url prefixes to exclude")
+    parser.add_option("--exclude-cache", dest="exclude_cache", help="Compiled form of --exclude-list, loaded with mmap. It is (re)built when missing or out of date")
     parser.add_option("--stats-file", dest="stats_file", help="Output json file containing statistics")
     parser.add_option("--no-host-massage", dest="canonicalizer_options",
                       action='append_const', const=('host_massage', False),
                       help='Turn off host_massage (ex. stripping "www.")')
+    parser.add_option("--urlkey-cache-size", dest="urlkey_cache_size", type="int", help="Number of canonicalized URLs to keep for reuse; 0 disables the cache [default: %default]")
+    parser.add_option("--streaming", dest="streaming", action="store_true", help="Read record payloads in chunks, so that large records are never loaded in memory as a whole")
+    parser.add_option("--chunk-size", dest="chunk_size", type="int", help="Payload read size in bytes for --streaming [default: %default]")
+    parser.add_option("--meta-scan-size", dest="meta_scan_size", type="int", help="Number of bytes at the start of HTML payloads to look for meta tags in [default: %default]")
+    parser.add_option("--parallel", dest="parallel", type="int", help="Index a gzipped WARC file with this many worker processes, splitting it at gzip member boundaries. Output is identical to serial run [default: %default]")
+    parser.add_option("--output-buffer-size", dest="output_buffer_size", type="int", help="Bytes of output to collect in memory before writing [default: %default]")
+    parser.add_option("--sorted", dest="sort", action="store_true", help="Sort output in the same order as 'LC_ALL=C sort', using temporary files if it does not fit in --sort-buffer-size")
+    parser.add_option("--sort-buffer-size", dest="sort_buffer_size", type="int", help="Memory to use for --sorted, in megabytes [default: %default]")
+    parser.add_option("--zipnum", dest="zipnum", action="store_true", help="Write sorted CDX as a ZipNum cluster to output_file.cdx.gz, with summary index output_file.idx and location file output_file.loc")
+    parser.add_option("--zipnum-lines", dest="zipnum_lines", type="int", help="Number of CDX lines in each gzip block of --zipnum output [default: %default]")
+    parser.add_option("--checkpoint", dest="checkpoint", help="Save progress to this file periodically, and resume from it if it exists. Requires output_file")
+    parser.add_option("--checkpoint-interval", dest="checkpoint_interval", type="int", help="Number of records between --checkpoint saves [default: %default]")
+    parser.add_option("--follow", dest="follow", action="store_true", help="Index a gzipped WARC file still being written, as records are completed, until it is renamed or removed, SIGTERM or SIGUSR1 is received, or --idle-timeout passes without new records")
+    parser.add_option("--poll-interval", dest="poll_interval", type="float", help="Seconds between checks for new records in --follow mode [default: %default]")
+    parser.add_option("--idle-timeout", dest="idle_timeout", type="float", help="Stop --follow after this many seconds without new records [default: %default]")
+    parser.add_option("--timing-interval", dest="timing_interval", type="int", help="Time pipeline stages and CDX fields of every N-th record, and write timings by handler class to 'timings' in --stats-file. 0 turns timing off [default: %default]")
+    parser.add_option("--progress", dest="progress", action="store_true", help="Print progress, throughput and ETA to stderr periodically")
+    parser.add_option("--progress-interval", dest="progress_interval", type="float", help="Seconds between --progress updates [default: %default]")
+    parser.add_option("--prometheus-file", dest="prometheus_file", help="Write statistics to this file in Prometheus text format, for node exporter textfile collector. Updated every --progress-interval seconds")
+    parser.add_option("--batch", dest="batch", action="store_true", help="Index many W/ARC files given as arguments, or listed one per line on stdin if none (or '-') is given. Combined CDX is written to stdout unless --output-dir is specified")
+    parser.add_option("--jobs", dest="jobs", type="int", help="Number of worker processes for --batch [default: number of CPUs]")
+    parser.add_option("--output-dir", dest="output_dir", help="Write CDX for each input file to this directory, instead of combined CDX to stdout (--batch only)")
 
     options, input_files = parser.parse_args(args=args)
 
+    zipnum_lines = options.zipnum_lines if options.zipnum else None
+
+    if options.batch:
+        if zipnum_lines and options.output_dir is None:
+            parser.error("--zipnum requires --output-dir with --batch")
+        if options.checkpoint:
+            parser.error("--checkpoint cannot be used with --batch")
+        if not input_files or input_files == ['-']:
+            input_files = [line.strip() for line in sys.stdin if line.strip()]
+        stats = make_cdx_batch(input_files, sys.stdout,
+                               output_dir      = options.output_dir,
+                               jobs            = options.jobs,
+                               stats_file      = options.stats_file,
+                               format          = options.format,
+                               use_full_path   = options.use_full_path,
+                               file_prefix     = options.file_prefix,
+                               all_records     = options.all_records,
+                               screenshot_mode = options.screenshot_mode,
+                               exclude_list    = options.exclude_list,
+                               exclude_cache   = options.exclude_cache,
+                               urlkey_cache_size = options.urlkey_cache_size,
+                               canonicalizer_options =
+                               options.canonicalizer_options,
+                               streaming       = options.streaming,
+                               chunk_size      = options.chunk_size,
+                               sort            = options.sort,
+                               sort_buffer_size = options.sort_buffer_size * 1024 * 1024,
+                               zipnum_lines    = zipnum_lines,
+                               timing_interval = options.timing_interval,
+                               progress        = options.progress,
+                               progress_interval = options.progress_interval,
+                               prometheus_file = options.prometheus_file,
+                               meta_scan_size  = options.meta_scan_size,
+                               output_buffer_size = options.output_buffer_size
+                              )
+        return 1 if stats['num_files_failed'] else 0
+
     if len(input_files) != 2:
+        if len(input_files) == 1 and zipnum_lines:
+            parser.error("--zipnum requires output_file")
+        if len(input_files) == 1 and options.checkpoint:
+            parser.error("--checkpoint requires output_file")
         if len(input_files) == 1:
             input_files.append(sys.stdout)
         else:
@@ -897,12 +3398,34 @@ def main(args):
                             all_records     = options.all_records,
                             screenshot_mode = options.screenshot_mode,
                             exclude_list    = options.exclude_list,
+                            exclude_cache   = options.exclude_cache,
+                            urlkey_cache_size = options.urlkey_cache_size,
                             stats_file      = options.stats_file,
                             canonicalizer_options =
-                            options.canonicalizer_options
+                            options.canonicalizer_options,
+                            streaming       = options.streaming,
+                            chunk_size      = options.chunk_size,
+                            parallel        = options.parallel,
+                            sort            = options.sort,
+                            sort_buffer_size = options.sort_buffer_size * 1024 * 1024,
+                            zipnum_lines    = zipnum_lines,
+                            checkpoint_file = options.checkpoint,
+                            checkpoint_interval = options.checkpoint_interval,
+                            follow          = options.follow,
+                            poll_interval   = options.poll_interval,
+                            idle_timeout    = options.idle_timeout,
+                            timing_interval = options.timing_interval,
+                            progress        = options.progress,
+                            progress_interval = options.progress_interval,
+                            prometheus_file = options.prometheus_file,
+                            meta_scan_size  = options.meta_scan_size,
+                            output_buffer_size = options.output_buffer_size,
+                            file_name       = options.file_name
                            )
     cdx_writer.make_cdx()
     return 0
 
 if __name__ == '__main__':
+    if sys.argv[1:2] == ['merge']:
+        exit(merge_main(sys.argv[2:]))
     exit(main(sys.argv[1:]))
@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+"""
+Benchmark cdx_writer.py on a fixed synthetic corpus made by warcgen.py,
+and check throughput and memory use against a saved baseline.
+
+    python tests/benchmark.py -o baseline.json
+    ... make changes ...
+    python tests/benchmark.py -o results.json --baseline baseline.json
+
+Each scenario runs :meth:`CDX_Writer.make_cdx` in a separate process
+``--repeat`` times. Results have records/s and MB/s of the fastest run,
+and peak RSS of the process. With ``--baseline``, exit status is 1 if
+throughput of any scenario drops, or its peak RSS grows, by more than
+``--threshold`` (fraction) compared with the baseline.
+"""
+import sys
+import os
+import json
+import time
+import platform
+import resource
+import tempfile
+import subprocess
+
+testdir = os.path.dirname(os.path.abspath(__file__))
+sys.path[0:0] = (os.path.join(testdir, '..'), testdir)
+import warcgen
+
+# corpus file name: (number of records (scaled), warcgen.Generator options)
+CORPUS = {
+    'synth.warc.gz': (5000, dict(seed=1, malformed=0.01)),
+    'synth.arc.gz': (5000, dict(seed=2, arc=True, malformed=0.01)),
+    'screenshot.warc.gz': (2000, dict(seed=3, mix=dict(screenshot=1))),
+    }
+
+EXCLUDE_LIST = 'excludes.txt'
+
+# scenario name: (corpus file name, CDX_Writer options)
+SCENARIOS = {
+    'default': ('synth.warc.gz', {}),
+    'all_records': ('synth.warc.gz', dict(all_records=True)),
+    'exclude_list': ('synth.warc.gz', dict(exclude_list=EXCLUDE_LIST)),
+    'arc': ('synth.arc.gz', {}),
+    'screenshot': ('screenshot.warc.gz', dict(screenshot_mode=True)),
+    }
+
+def make_corpus(corpus_dir, scale=1.0):
+    """Generate corpus files in `corpus_dir` unless they already exist.
+    Files are named after the number of records, so that different `scale`
+    doesn't reuse them. Return a dict of corpus file name to path.
+    """
+    if not os.path.isdir(corpus_dir):
+        os.makedirs(corpus_dir)
+    paths = {}
+    for name, (records, options) in sorted(CORPUS.items()):
+        records = max(2, int(records * scale))
+        path = os.path.join(corpus_dir, '{}-{}'.format(records, name))
+        if not os.path.exists(path):
+            generator = warcgen.Generator(filename=os.path.basename(path),
+                                          **options)
+            # keep the suffix, by which write_file decides to gzip
+            tmp = os.path.join(corpus_dir, 'tmp-' + os.path.basename(path))
+            warcgen.write_file(tmp, generator, records=records)
+            os.rename(tmp, path)
+        paths[name] = path
+
+    # every 10th host excluded, plus prefixes not matching anything
+    path = os.path.join(corpus_dir, EXCLUDE_LIST)
+    if not os.path.exists(path):
+        with open(path + '.tmp', 'w') as f:
+            for host in warcgen.Generator().hosts[::10]:
+                f.write('http://{}/\n'.format(host))
+            for i in range(10000):
+                f.write('http://www.excluded{}.example.com/\n'.format(i))
+        os.rename(path + '.tmp', path)
+    paths[EXCLUDE_LIST] = path
+    return paths
+
+def peak_rss_mb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on Mac OS X
+    if sys.platform == 'darwin':
+        rss /= 1024
+    return rss / 1024.0
+
+def run_scenario(name, corpus_dir, scale, repeat):
+    """Run scenario `name` `repeat` times in this process, and return its
+    result.
+    """
+    from cdx_writer import CDX_Writer
+    paths = make_corpus(corpus_dir, scale)
+    corpus, options = SCENARIOS[name]
+    options = dict(options)
+    if 'exclude_list' in options:
+        options['exclude_list'] = paths[options['exclude_list']]
+    path = paths[corpus]
+
+    best = None
+    with open(os.devnull, 'wb') as out:
+        for i in range(repeat):
+            started = time.time()
+            stats = CDX_Writer(path, out, **options).make_cdx()
+            elapsed = time.time() - started
+            if best is None or elapsed < best:
+                best = elapsed
+    size = os.path.getsize(path)
+    return {
+        'corpus': os.path.basename(path),
+        'records': stats['num_records_processed'],
+        'seconds': best,
+        'records_per_second': stats['num_records_processed'] / best,
+        'mb_per_second': size / (1024.0 * 1024) / best,
+        'peak_rss_mb': peak_rss_mb(),
+        }
+
+def compare_results(results, baseline, threshold):
+    """Return a list of regressions of `results` from `baseline`, as
+    messages. Throughput lower, or peak RSS higher, than baseline by more than
+    fraction `threshold` is a regression.
+    """
+    regressions = []
+    for name, base in sorted(baseline['scenarios'].items()):
+        result = results['scenarios'].get(name)
+        if result is None:
+            continue
+        for key in ('records_per_second', 'mb_per_second'):
+            if result[key] < base[key] * (1 - threshold):
+                regressions.append('{}: {} {:.1f} < baseline {:.1f}'.format(
+                    name, key, result[key], base[key]))
+        if result['peak_rss_mb'] > base['peak_rss_mb'] * (1 + threshold):
+            regressions.append('{}: peak_rss_mb {:.1f} > baseline {:.1f}'.format(
+                name, result['peak_rss_mb'], base['peak_rss_mb']))
+    return regressions
+
+def main(args):
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Benchmark cdx_writer.py")
+    parser.add_argument("-o", "--output", help="write results to this JSON file")
+    parser.add_argument("--baseline", help="JSON results to compare with")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="allowed fraction of regression [default: 0.1]")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="runs of each scenario, fastest is taken [default: 3]")
+    parser.add_argument("--scale", type=float, default=1.0,
+                        help="scale number of records in corpus [default: 1.0]")
+    parser.add_argument("--corpus-dir", default=os.path.join(tempfile.gettempdir(), 'cdx_writer_bench'),
+                        help="directory for generated corpus [default: %(default)s]")
+    parser.add_argument("--scenario", action="append", choices=sorted(SCENARIOS),
+                        help="scenario to run (repeatable) [default: all]")
+    parser.add_argument("--run", help=argparse.SUPPRESS)
+    args = parser.parse_args(args)
+
+    if args.run:
+        # child process running one scenario
+        result = run_scenario(args.run, args.corpus_dir, args.scale, args.repeat)
+        json.dump(result, sys.stdout)
+        return 0
+
+    make_corpus(args.corpus_dir, args.scale)
+    results = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'scale': args.scale,
+        'scenarios': {},
+        }
+    for name in args.scenario or sorted(SCENARIOS):
+        output = subprocess.check_output([
+            sys.executable, os.path.abspath(__file__), '--run', name,
+            '--corpus-dir', args.corpus_dir, '--scale', str(args.scale),
+            '--repeat', str(args.repeat)])
+        result = json.loads(output)
+        results['scenarios'][name] = result
+        print >>sys.stderr, "{:<14} {:>10.1f} records/s {:>8.2f} MB/s {:>8.1f} MB peak RSS".format(
+            name, result['records_per_second'], result['mb_per_second'],
+            result['peak_rss_mb'])
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=4, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare_results(results, baseline, args.threshold)
+        for regression in regressions:
+            print >>sys.stderr, "REGRESSION", regression
+        if regressions:
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    exit(main(sys.argv[1:]))
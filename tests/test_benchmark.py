@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+"""
+Test benchmark.py on a tiny corpus.
+"""
+import py
+import sys
+import json
+
+testdir = py.path.local(__file__).dirpath()
+sys.path[0:0] = (str(testdir / '..'), str(testdir))
+import benchmark
+
+def result(rps, mbps, rss):
+    return dict(records_per_second=rps, mb_per_second=mbps, peak_rss_mb=rss)
+
+def test_compare_results():
+    baseline = {'scenarios': {'a': result(100, 10, 50), 'b': result(100, 10, 50)}}
+    results = {'scenarios': {'a': result(95, 9.5, 54), 'b': result(85, 10, 56)}}
+    assert benchmark.compare_results(results, baseline, 0.1) == [
+        'b: records_per_second 85.0 < baseline 100.0',
+        'b: peak_rss_mb 56.0 > baseline 50.0',
+        ]
+    assert benchmark.compare_results(results, baseline, 0.2) == []
+    # scenarios missing in either are not compared
+    assert benchmark.compare_results({'scenarios': {}}, baseline, 0.1) == []
+
+def test_benchmark(tmpdir):
+    corpus_dir = tmpdir / 'corpus'
+    output = tmpdir / 'results.json'
+    args = ['--corpus-dir', str(corpus_dir), '--scale', '0.01', '--repeat', '1']
+    assert benchmark.main(args + ['-o', str(output)]) == 0
+
+    results = json.loads(output.read_text('utf-8'))
+    assert sorted(results['scenarios']) == sorted(benchmark.SCENARIOS)
+    for name, r in results['scenarios'].items():
+        assert r['records'] > 0
+        assert r['records_per_second'] > 0
+        assert r['mb_per_second'] > 0
+        assert r['peak_rss_mb'] > 0
+    assert results['scenarios']['default']['records'] == 50
+
+    baseline = tmpdir / 'baseline.json'
+    results['scenarios']['default']['records_per_second'] *= 1000
+    baseline.write_text(json.dumps(results).decode('ascii'), 'utf-8')
+    args += ['--scenario', 'default', '--baseline', str(baseline)]
+    assert benchmark.main(args) == 1
+    assert benchmark.main(args + ['--threshold', '1']) == 0
@@ -5,6 +5,8 @@ import pytest
 import py
 import json
 import os
+import sys
+import random
 import subprocess
 
 
@@ -43,9 +45,12 @@ com,monsterindia,jobs)/details/9660976.html 20110804181044 http://jobs.monsterin
 testdir = py.path.local(__file__).dirpath()
 datadir = testdir / "small_warcs"
 cdx_writer = str(testdir / "../cdx_writer.py")
+sys.path[0:0] = (str(testdir / '..'),)
+from cdx_writer import PrefixSet
 
 @pytest.mark.parametrize("test", tests)
-def test_exlcudes(test, tmpdir):
+@pytest.mark.parametrize("use_cache", [False, True])
+def test_exlcudes(test, use_cache, tmpdir):
     test_file = test['file']
     exclude_list = tmpdir / 'tmp_excludes.txt'
     stats_file   = tmpdir / 'tmp_stats.json'
@@ -56,6 +61,8 @@ def test_exlcudes(test, tmpdir):
 
     cmd = [cdx_writer, '--all-records', '--exclude-list='+str(exclude_list),
            '--stats-file='+str(stats_file), str(test_file)]
+    if use_cache:
+        cmd.insert(1, '--exclude-cache='+str(tmpdir / 'tmp_excludes.idx'))
 
     with datadir.as_cwd():
         output = subprocess.check_output(cmd)
@@ -65,3 +72,64 @@ def test_exlcudes(test, tmpdir):
     stats = json.loads(stats_file.read_text('utf-8'))
 
     assert stats['num_records_filtered'] == test['num_filtered']
+
+def test_prefix_set():
+    '''PrefixSet matches exactly like checking every prefix with startswith.'''
+    rnd = random.Random(4)
+    def randstr(lo, hi):
+        return ''.join(rnd.choice('abc,)/') for _ in range(rnd.randint(lo, hi)))
+    prefixes = [randstr(2, 6) for _ in range(200)] + ['com,example)/', 'com,example']
+    pset = PrefixSet(prefixes)
+    assert len(pset) <= len(prefixes)
+
+    keys = [randstr(0, 10) for _ in range(2000)] + ['com,example)/index.html', 'com,exampl']
+    for key in keys:
+        expected = any(key.startswith(p) for p in prefixes)
+        assert pset.match(key) == expected, key
+
+def test_exclude_cache(tmpdir):
+    '''Compiled exclude list is reused while up to date, and rebuilt when
+    exclude list changes.'''
+    exclude_list = tmpdir / 'excludes.txt'
+    exclude_cache = tmpdir / 'excludes.idx'
+    cmd = [cdx_writer, '--all-records', '--exclude-list='+str(exclude_list),
+           '--exclude-cache='+str(exclude_cache), 'uncompressed.arc']
+
+    exclude_list.write(tests[0]['exclude'] + '\n')
+    with datadir.as_cwd():
+        output = subprocess.check_output(cmd)
+    assert output == tests[0]['result']
+    assert exclude_cache.exists()
+
+    exclude_cache_stat = exclude_cache.stat()
+    with datadir.as_cwd():
+        output = subprocess.check_output(cmd)
+    assert output == tests[0]['result']
+    assert exclude_cache.stat().mtime == exclude_cache_stat.mtime
+    assert exclude_cache.stat().ino == exclude_cache_stat.ino
+
+    exclude_list.write(tests[1]['exclude'] + '\n')
+    with datadir.as_cwd():
+        output = subprocess.check_output(cmd)
+    assert output == tests[1]['result']
+    assert exclude_cache.stat().ino != exclude_cache_stat.ino
+
+@pytest.mark.parametrize("content", ['', 'CDXEXC01', 'garbage' * 100, None])
+def test_exclude_cache_unreadable(content, tmpdir):
+    '''Empty, truncated or corrupt compiled exclude list is rebuilt.'''
+    exclude_list = tmpdir / 'excludes.txt'
+    exclude_cache = tmpdir / 'excludes.idx'
+    cmd = [cdx_writer, '--all-records', '--exclude-list='+str(exclude_list),
+           '--exclude-cache='+str(exclude_cache), 'uncompressed.arc']
+
+    exclude_list.write(tests[0]['exclude'] + '\n')
+    if content is None:
+        # valid cache, cut short
+        with datadir.as_cwd():
+            subprocess.check_output(cmd)
+        content = exclude_cache.read_binary()[:-3]
+    exclude_cache.write_binary(content)
+    with datadir.as_cwd():
+        output = subprocess.check_output(cmd)
+    assert output == tests[0]['result']
+    assert exclude_cache.read_binary() != content
@@ -9,7 +9,6 @@ import base64
 import io
 from gzip import GzipFile
 from cdx_writer import CDX_Writer
-from hanzo.warctools import WarcRecord
 
 def create_metadata_record_bytes(
     url='http://example.com/',
@@ -20,40 +19,28 @@ def create_metadata_record_bytes(
     """Build WARC metadata record bits."""
 
     headers = {
-        WarcRecord.TYPE: WarcRecord.METADATA,
-        WarcRecord.URL: url.encode('utf-8'),
-        WarcRecord.CONTENT_TYPE: content_type.encode('utf-8'),
-        WarcRecord.DATE: date.encode('utf-8')
+        b'WARC-Type': b'metadata',
+        b'WARC-Target-URI': url.encode('utf-8'),
+        b'Content-Type': content_type.encode('utf-8'),
+        b'WARC-Date': date.encode('utf-8')
         }
     if include_block_digest:
         hasher = hashlib.sha1(content)
         block_digest = base64.b32encode(hasher.digest())
-        headers[WarcRecord.BLOCK_DIGEST] = b'sha1:' + block_digest
+        headers[b'WARC-Block-Digest'] = b'sha1:' + block_digest
 
-    # XXX - I wish I could use WarcRecord. Current implementation of
-    # WarcRecord.write_to() ignores Warc-Block-Digest passed and writes out
-    # hex-encoded SHA256 calculated from the content.
     out = io.BytesIO()
-    if False:
-        rec = WarcRecord(
-            headers=headers.items(),
-            content=(content_type.encode('utf-8'), content)
-            )
-        out = io.BytesIO()
-        rec.write_to(out, gzip=True)
-        return out.getvalue()
-    else:
-        z = GzipFile(fileobj=out, mode='wb')
-        z.write(b'WARC/1.0\r\n')
-        for k, v in headers.items():
-            z.write(b''.join((k, b': ', v, b'\r\n')))
-        z.write('Content-Length: {}\r\n'.format(len(content)).encode('ascii'))
-        z.write(b'\r\n')
-        z.write(content)
-        z.write(b'\r\n\r\n')
-        z.flush()
-        z.close()
-        return out.getvalue()
+    z = GzipFile(fileobj=out, mode='wb')
+    z.write(b'WARC/1.0\r\n')
+    for k, v in headers.items():
+        z.write(b''.join((k, b': ', v, b'\r\n')))
+    z.write('Content-Length: {}\r\n'.format(len(content)).encode('ascii'))
+    z.write(b'\r\n')
+    z.write(content)
+    z.write(b'\r\n\r\n')
+    z.flush()
+    z.close()
+    return out.getvalue()
 
 @pytest.mark.parametrize("block_digest", [ True, False ])
 def test_sceenshot_regular(block_digest, tmpdir):
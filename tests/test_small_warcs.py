@@ -5,6 +5,11 @@ import pytest
 import py
 import os
 import sys
+import json
+import gzip
+import zlib
+import time
+import threading
 
 # {warc-filename: output-of-cdx_writer.py--all-records, ...}
 warcs_all_records = {
@@ -105,40 +110,545 @@ datadir = testdir / "small_warcs"
 sys.path[0:0] = (str(testdir / '..'),)
 cdx_writer = __import__('cdx_writer')
 
-@pytest.mark.parametrize(["file", "expected"], warcs_all_records.iteritems())
-def test_all_records(file, expected, tmpdir):
-    '''Test `cdx_writer.py --all-records WARC`.'''
-    assert datadir.join(file).exists()
-
-    args = ['--all-records', file]
-    with datadir.as_cwd():
-        outpath = tmpdir / 'stdout'
-        saved_stdout = sys.stdout
+def run_main(args, tmpdir, cwd=datadir, stdin=None):
+    '''Run `cdx_writer.py args` in directory `cwd`, with file `stdin` as
+    standard input if given, check that it succeeds, and return its
+    standard output.
+    '''
+    outpath = tmpdir / 'stdout'
+    saved = sys.stdout, sys.stdin
+    with cwd.as_cwd():
         sys.stdout = outpath.open(mode='wb')
+        if stdin is not None:
+            sys.stdin = stdin.open('rb')
         try:
             status = cdx_writer.main(args)
         finally:
             sys.stdout.close()
-            output = outpath.read_binary()
-            sys.stdout = saved_stdout
+            if stdin is not None:
+                sys.stdin.close()
+            sys.stdout, sys.stdin = saved
     assert 0 == status
-    assert output == expected
+    return outpath.read_binary()
+
+@pytest.mark.parametrize(["file", "expected"], warcs_all_records.iteritems())
+def test_all_records(file, expected, tmpdir):
+    '''Test `cdx_writer.py --all-records WARC`.'''
+    assert datadir.join(file).exists()
+    assert run_main(['--all-records', file], tmpdir) == expected
 
 @pytest.mark.parametrize(["file", "expected"], warcs_defaults.iteritems())
 def test_defaults(file, expected, tmpdir):
     '''Test `cdx_writer.py WARC`.'''
     assert datadir.join(file).exists()
+    assert run_main([file], tmpdir) == expected
+
+@pytest.mark.parametrize(["file", "expected"], warcs_all_records.iteritems())
+def test_streaming(file, expected, tmpdir):
+    '''Test `cdx_writer.py --all-records --streaming WARC`.
+    Tiny chunk size makes HTTP headers span multiple chunks.
+    '''
+    args = ['--all-records', '--streaming', '--chunk-size=7', file]
+    assert run_main(args, tmpdir) == expected
+
+@pytest.mark.parametrize(["file", "expected"], warcs_all_records.iteritems())
+@pytest.mark.parametrize("streaming", [False, True])
+def test_stdin(file, expected, streaming, tmpdir, monkeypatch):
+    '''Test `cdx_writer.py --all-records --file-name WARC - < WARC`.'''
+    args = ['--all-records', '--file-name', file, '-']
+    if streaming:
+        args[:0] = ['--streaming', '--chunk-size=7']
+        # large records are streamed
+        monkeypatch.setattr(cdx_writer.CDX_Writer, 'max_member_size', 1000)
+    assert run_main(args, tmpdir, stdin=datadir.join(file)) == expected
+
+@pytest.mark.parametrize("file", ['uncompressed.arc', 'uncompressed.warc'])
+@pytest.mark.parametrize("streaming", [False, True])
+@pytest.mark.parametrize("stdin", [False, True])
+def test_whole_file_gzip(file, streaming, stdin, tmpdir, monkeypatch):
+    '''Test `cdx_writer.py --all-records WARC.gz` where WARC.gz is whole
+    WARC gzipped as one member: all records have its offset and length.
+    '''
+    gzfile = tmpdir / (file + '.gz')
+    with gzip.open(str(gzfile), 'wb') as f:
+        f.write(datadir.join(file).read_binary())
+    size = gzfile.size()
+    lines = warcs_all_records[file].replace(file, gzfile.basename).splitlines(True)
+    expected = lines[0] + b''.join(
+        line.rsplit(b' ', 3)[0] + b' %d 0 %s\n' % (size, gzfile.basename)
+        for line in lines[1:])
+
+    args = ['--all-records', gzfile.basename]
+    if streaming:
+        args[:0] = ['--streaming', '--chunk-size=7']
+        # member is decompressed again for reading its records
+        monkeypatch.setattr(cdx_writer.CDX_Writer, 'max_member_size', 1000)
+    if stdin:
+        args[-1:] = ['--file-name', gzfile.basename, '-']
+    output = run_main(args, tmpdir, cwd=tmpdir, stdin=gzfile if stdin else None)
+    assert output == expected
+
+def test_zero_padding(tmpdir):
+    '''Zero padding after the last gzip member is skipped.'''
+    file = 'wget_ia.warc.gz'
+    padded = tmpdir / 'padded.warc.gz'
+    padded.write_binary(datadir.join(file).read_binary() + b'\0' * 512)
+    expected = warcs_all_records[file].replace(file, padded.basename)
+    assert run_main(['--all-records', padded.basename], tmpdir, cwd=tmpdir) == expected
+
+@pytest.mark.parametrize("streaming", [False, True])
+def test_truncated_member(streaming, tmpdir, monkeypatch):
+    '''Truncated last gzip member raises ParseError.'''
+    truncated = tmpdir / 'truncated.warc.gz'
+    truncated.write_binary(datadir.join('wget_ia.warc.gz').read_binary()[:-100])
+    args = ['--all-records', str(truncated)]
+    if streaming:
+        args[:0] = ['--streaming']
+        monkeypatch.setattr(cdx_writer.CDX_Writer, 'max_member_size', 1000)
+    with pytest.raises(cdx_writer.ParseError):
+        run_main(args, tmpdir)
+
+def test_stream_file():
+    from io import BytesIO
+    data = b''.join(b'line %d\n' % i for i in range(100))
+    f = cdx_writer.StreamFile(BytesIO(data), blocksize=16)
+    assert f.read(2) == b'li'
+    f.seek(0)
+    assert f.readline() == b'line 0\n'
+    assert f.readline(3) == b'lin'
+    assert f.tell() == 10
+    f.seek(100)
+    assert f.read(20) == data[100:120]
+    with pytest.raises(IOError):
+        f.seek(50)
+    assert f.readline() == data[120:data.index(b'\n', 120) + 1]
+    pos = f.tell()
+    assert f.read() == data[pos:]
+    assert f.tell() == len(data)
+    assert f.readline() == b''
+
+def test_spool_file():
+    from io import BytesIO
+    data = b''.join(b'line %d\n' % i for i in range(100))
+    f = cdx_writer.SpoolFile(cdx_writer.StreamFile(BytesIO(data), blocksize=16),
+                             max_size=100)
+    assert f.read(200) == data[:200]
+    f.seek(10)
+    assert f.read(20) == data[10:30]
+    assert f.tell() == 30
+    f.seek(300)
+    assert f.read(10) == data[300:310]
+    f.release(250)
+    with pytest.raises(IOError):
+        f.seek(200)
+    f.seek(250)
+    assert f.read() == data[250:]
+    assert f.read() == b''
+    f.close()
+
+@pytest.mark.parametrize(["file", "expected"], warcs_all_records.iteritems())
+def test_format_subset(file, expected, tmpdir, monkeypatch):
+    '''Test `cdx_writer.py --all-records --format='N b a S V g' WARC`
+    gives the same values for the fields as default format, without parsing
+    HTTP headers and content.
+    '''
+    def fail(self):
+        raise AssertionError('payload parsed')
+    monkeypatch.setattr(cdx_writer.ResponseHandler, 'parse_headers_and_content', fail)
+    monkeypatch.setattr(cdx_writer.ResponseHandler, 'parse_meta_tags', fail)
+
+    output = run_main(['--all-records', '--format=N b a S V g', file], tmpdir)
+
+    lines = expected.splitlines()
+    assert lines[0] == b' CDX N b a m s k r M S V g'
+    subset = [b' CDX N b a S V g']
+    for line in lines[1:]:
+        fields = line.split(b' ')
+        subset.append(b' '.join(fields[0:3] + fields[8:11]))
+    assert output.splitlines() == subset
+
+def test_batch(tmpdir):
+    '''Test `cdx_writer.py --batch --jobs=2 WARC...`.
+    Combined CDX has one header line, and records in the order of inputs.
+    '''
+    files = sorted(warcs_defaults)
+    expected = b' CDX N b a m s k r M S V g\n' + b''.join(
+        warcs_defaults[file].split(b'\n', 1)[1] for file in files)
+
+    assert run_main(['--batch', '--jobs=2'] + files, tmpdir) == expected
+
+def test_parallel(tmpdir):
+    '''Test `cdx_writer.py --parallel=N WARC` gives the same output as serial
+    run, on a WARC made by concatenating gzipped WARCs.
+    '''
+    files = ['empty-gzips.warc.gz', 'wget_ia.warc.gz', 'giant_html.warc.gz',
+             'password-protected.warc.gz', 'tweet.warc.gz']
+    warc = tmpdir / 'concat.warc.gz'
+    warc.write_binary(b''.join(datadir.join(f).read_binary() for f in files))
+
+    outputs = []
+    for args in (['--all-records'], ['--all-records', '--parallel=3']):
+        outputs.append(run_main(args + [warc.basename], tmpdir, cwd=tmpdir))
+    assert len(outputs[0].splitlines()) == 1 + 9 + 2 + 1 + 1 + 1
+    assert outputs[1] == outputs[0]
+
+def test_urlkey_cache(tmpdir):
+    '''Test urlkey cache gives the same output as no cache, and counts
+    records sharing URL as cache hits.
+    '''
+    file = 'empty-gzips.warc.gz'
+    stats_file = tmpdir / 'stats.json'
+
+    outputs = []
+    for size in (0, 2):
+        args = ['--all-records', '--urlkey-cache-size=%d' % size, file]
+        if size:
+            args.insert(0, '--stats-file=' + str(stats_file))
+        outputs.append(run_main(args, tmpdir))
+    assert outputs[1] == outputs[0]
+
+    stats = json.loads(stats_file.read_text('utf-8'))
+    assert stats['urlkey_cache_misses'] == 1
+    assert stats['urlkey_cache_hits'] > 0
+
+def test_lru_cache():
+    cache = cdx_writer.LRUCache(2)
+    cache['a'] = 1
+    cache['b'] = 2
+    assert cache.get('a') == 1
+    cache['c'] = 3
+    # 'b' is least recently used
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+    assert len(cache) == 2
+    assert (cache.hits, cache.misses) == (3, 1)
 
+def test_buffered_writer():
+    from io import BytesIO
+    f = BytesIO()
+    out = cdx_writer.BufferedWriter(f, buffer_size=10)
+    out.write('12345\n')
+    assert f.getvalue() == ''
+    assert out.tell() == 6
+    out.writelines(['abcde\n', 'x\n'])
+    # written when buffer_size is reached
+    assert f.getvalue() == '12345\nabcde\n'
+    out.close()
+    assert f.getvalue() == '12345\nabcde\nx\n'
+    assert not f.closed
+
+def test_http_headers():
+    '''HttpHeaders gives the same values as matching ``name:\\s*(.+)``
+    on each line, first match winning.
+    '''
+    import re
+    lines = ['HTTP/1.1 200 OK', 'Content-Type:', 'content-type: \t',
+             'CONTENT-TYPE:text/html; charset=utf-8', 'X-Robots-Tag: noindex',
+             'x-robots-tag:  nofollow ', 'Content-Type-Options: nosniff',
+             ' Location: /indented', 'no colon here', 'Empty:']
+    headers = cdx_writer.HttpHeaders(lines)
+    for name in ('content-type', 'x-robots-tag', 'content-type-options',
+                 'location', 'empty', 'missing', 'X-Robots-Tag'):
+        pattern = re.compile(name + ':\s*(.+)', re.I)
+        matches = [m.group(1) for m in map(pattern.match, lines) if m]
+        assert headers.get_all(name) == matches
+        assert headers.get(name) == (matches[0] if matches else None)
+    assert headers.get('content-type') == '\t'
+
+def test_scan_meta_tags():
+    html = ('\n <HTML><head><noscript><META NAME="Robots" CONTENT="noarchive">'
+            '</noscript><meta name=robots content=nofollow />'
+            '<meta http-equiv="refresh" content="0; url=/a">'
+            '<meta http-equiv="Refresh" content="5; url=/b">'
+            '<meta name="description"><meta charset="utf-8">'
+            '</HEAD><meta name="robots" content="noindex">')
+    expected = {'robots': 'noarchive,nofollow', 'refresh': '0; url=/a'}
+    assert cdx_writer.scan_meta_tags(html, len(html)) == expected
+    # without </head>, scan stops at <body
+    html = html.replace('</HEAD>', '<Body class="x">')
+    assert cdx_writer.scan_meta_tags(html, len(html)) == expected
+    # only first `size` bytes are looked at
+    size = html.index('<meta name=robots') + 10
+    assert cdx_writer.scan_meta_tags(html, size) == {'robots': 'noarchive'}
+    assert cdx_writer.scan_meta_tags('', 100) == {}
+
+@pytest.mark.parametrize("date", [
+    '2017-03-03T02:42:45Z', '2019-11-18T12:56:03.123456789Z',
+    '2016-02-29T23:59:59Z', '2000-02-29T00:00:00Z', '1900-02-29T00:00:00Z',
+    '2017-02-29T00:00:00Z', '2017-04-31T00:00:00Z', '2017-13-01T00:00:00Z',
+    '2017-00-10T00:00:00Z', '2017-01-00T00:00:00Z', '2017-01-01T24:00:00Z',
+    '2017-01-01T00:60:00Z', '2017-01-01T00:00:60Z', '1899-12-31T23:59:59Z',
+    '2017-1-01T00:00:00Z', '2017-01-01 00:00:00Z', '2017-01-01T00:00',
+    '+017-01-01T00:00:00Z', '2017-01-01T0a:00:00Z', 'garbage'])
+def test_warc_date_timestamp(date):
+    '''Timestamps are the same as from datetime, which raises ValueError for
+    invalid dates.
+    '''
+    from datetime import datetime
+    try:
+        expected = datetime.strptime(date[:19], "%Y-%m-%dT%H:%M:%S").strftime(
+            "%Y%m%d%H%M%S")
+    except ValueError:
+        with pytest.raises(ValueError):
+            cdx_writer.warc_date_timestamp(date)
+    else:
+        # second call is from cache
+        assert cdx_writer.warc_date_timestamp(date) == expected
+        assert cdx_writer.warc_date_timestamp(date) == expected
+
+@pytest.mark.parametrize("file,expected", warcs_all_records.items())
+def test_sorted(file, expected, tmpdir):
+    '''Test sorted output, with small buffer to make it use temporary files.
+    Output is in the same order as ``LC_ALL=C sort``.
+    '''
+    assert datadir.join(file).exists()
+
+    outpath = tmpdir / 'out.cdx'
     with datadir.as_cwd():
-        outpath = tmpdir / 'stdout'
-        saved_stdout = sys.stdout
-        sys.stdout = outpath.open(mode='wb')
-        try:
-            status = cdx_writer.main([file])
-        finally:
-            sys.stdout.close()
-            output = outpath.read_binary()
-            sys.stdout = saved_stdout
+        writer = cdx_writer.CDX_Writer(file, str(outpath), all_records=True,
+                                       sort=True, sort_buffer_size=200)
+        writer.make_cdx()
+    lines = sorted(expected.splitlines())
+    assert outpath.read_binary() == b''.join(line + b'\n' for line in lines)
+
+def test_merge_sorted_lines():
+    '''Lines are compared without newline, as ``LC_ALL=C sort -m`` does.'''
+    merged = cdx_writer.merge_sorted_lines([['a\tb\n', 'b'], ['a\n', 'a b\n']])
+    assert list(merged) == ['a\n', 'a\tb\n', 'a b\n', 'b\n']
+
+def test_merge(tmpdir):
+    '''Test `cdx_writer.py merge` of sorted CDX files, plain and gzipped,
+    merged in multiple passes.
+    '''
+    files = sorted(warcs_all_records)[:7]
+    paths = []
+    for i, file in enumerate(files):
+        lines = sorted(warcs_all_records[file].splitlines())
+        path = tmpdir / '{}.cdx'.format(i)
+        if i % 2:
+            path = tmpdir / '{}.cdx.gz'.format(i)
+            f = gzip.open(str(path), 'wb')
+        else:
+            f = path.open('wb')
+        with f:
+            f.writelines(line + b'\n' for line in lines)
+        paths.append(str(path))
+    # duplicate input
+    paths.append(paths[0])
+
+    lines = sorted(line for file in files + files[:1]
+                   for line in warcs_all_records[file].splitlines()[1:])
+    header = b' CDX N b a m s k r M S V g\n'
+
+    outpath = tmpdir / 'merged.cdx'
+    status = cdx_writer.merge_main(['--max-open-files=3', '-o', str(outpath)] + paths)
     assert 0 == status
-    assert output == expected
+    assert outpath.read_binary() == header + b''.join(l + b'\n' for l in lines)
+
+    outpath = tmpdir / 'unique.cdx'
+    status = cdx_writer.merge_main(['-u', '-o', str(outpath)] + paths)
+    assert 0 == status
+    lines = sorted(set(lines))
+    assert outpath.read_binary() == header + b''.join(l + b'\n' for l in lines)
+
+def test_zipnum(tmpdir):
+    '''Test `cdx_writer.py --zipnum` output: gzip blocks of sorted lines,
+    summary index pointing to each of them, and location file.
+    '''
+    file = 'empty-gzips.warc.gz'
+    outpath = tmpdir / 'out.cdx.gz'
+    args = ['--all-records', '--zipnum', '--zipnum-lines=4', file, str(outpath)]
+    run_main(args, tmpdir)
+
+    lines = sorted(warcs_all_records[file].splitlines()[1:])
+    assert len(lines) == 9
+    data = outpath.read_binary()
+    idx = (tmpdir / 'out.idx').read_binary().splitlines()
+    assert len(idx) == 3
+    for i, entry in enumerate(idx):
+        key, name, offset, length, num = entry.split(b'\t')
+        assert name == b'out'
+        assert int(num) == i + 1
+        block = data[int(offset):int(offset) + int(length)]
+        block_lines = lines[i * 4:(i + 1) * 4]
+        assert zlib.decompress(block, 16 + zlib.MAX_WBITS) == b''.join(
+            l + b'\n' for l in block_lines)
+        assert key == b' '.join(block_lines[0].split(b' ')[:2])
+    assert (tmpdir / 'out.loc').read_binary() == b'out\tout.cdx.gz\n'
+
+class Interrupted(Exception):
+    pass
+
+@pytest.mark.parametrize("file", ['empty-gzips.warc.gz', 'uncompressed.arc'])
+def test_checkpoint(file, tmpdir, monkeypatch):
+    '''Test indexing interrupted after a checkpoint resumes to give the same
+    output and stats as uninterrupted run.
+    '''
+    outpath = tmpdir / 'out.cdx'
+    checkpoint = tmpdir / 'checkpoint.json'
+    stats_file = tmpdir / 'stats.json'
+    args = ['--all-records', '--timing-interval=1', '--checkpoint=' + str(checkpoint),
+            '--checkpoint-interval=2', '--stats-file=' + str(stats_file),
+            file, str(outpath)]
+    run_main(args[:-1] + [str(tmpdir / 'full.cdx')], tmpdir)
+    full_stats = json.loads(stats_file.read_text('utf-8'))
+    stats_file.remove()
+
+    save_checkpoint = cdx_writer.CDX_Writer.save_checkpoint
+    def interrupting_save_checkpoint(self, offset, stats):
+        save_checkpoint(self, offset, stats)
+        # partially written line after the checkpoint
+        self.out_file.write(b'com,example)/ 2017')
+        raise Interrupted()
+    monkeypatch.setattr(cdx_writer.CDX_Writer, 'save_checkpoint',
+                        interrupting_save_checkpoint)
+    with pytest.raises(Interrupted):
+        run_main(args, tmpdir)
+    assert checkpoint.exists()
+    monkeypatch.undo()
+
+    run_main(args, tmpdir)
+    assert outpath.read_binary() == warcs_all_records[file]
+    assert not checkpoint.exists()
+    stats = json.loads(stats_file.read_text('utf-8'))
+    num_records = len(warcs_all_records[file].splitlines()) - 1
+    assert stats['num_records_processed'] == num_records
+    assert stats['num_records_included'] == num_records
+    # counted outside stats before merged; cache is cold after resuming
+    lookups = lambda s: s['urlkey_cache_hits'] + s['urlkey_cache_misses']
+    assert lookups(stats) == lookups(full_stats)
+    assert ({k: t['records'] for k, t in stats['timings'].items()} ==
+            {k: t['records'] for k, t in full_stats['timings'].items()})
+
+def test_restart_before_checkpoint(tmpdir, monkeypatch):
+    '''Run failing before the first checkpoint can be restarted with the
+    same stats file.
+    '''
+    file = 'empty-gzips.warc.gz'
+    outpath = tmpdir / 'out.cdx'
+    stats_file = tmpdir / 'stats.json'
+    args = ['--all-records', '--checkpoint=' + str(tmpdir / 'checkpoint.json'),
+            '--stats-file=' + str(stats_file), file, str(outpath)]
+    def fail(self, stats):
+        raise Interrupted()
+    monkeypatch.setattr(cdx_writer.CDX_Writer, '_make_cdx', fail)
+    with pytest.raises(Interrupted):
+        run_main(args, tmpdir)
+    assert not stats_file.exists()
+    monkeypatch.undo()
+
+    run_main(args, tmpdir)
+    assert outpath.read_binary() == warcs_all_records[file]
+    assert stats_file.exists()
+
+@pytest.mark.parametrize("padding", [False, True])
+def test_follow(padding, tmpdir):
+    '''Test `cdx_writer.py --follow` on a WARC file written in parts, which
+    is renamed to drop ``.open`` suffix when finished. With `padding`,
+    members have zero padding between them.
+    '''
+    file = 'empty-gzips.warc.gz'
+    data = datadir.join(file).read_binary()
+    expected = warcs_all_records[file]
+    if padding:
+        with datadir.join(file).open('rb') as f:
+            members = list(cdx_writer.gzip_members(f))
+        data = b''.join(data[offset:offset + length] + b'\0' * 100
+                        for offset, length, _, _ in members)
+        # offsets are shifted by padding before them, largest first
+        for i, (offset, _, _, _) in reversed(list(enumerate(members))):
+            expected = expected.replace(b' %d %s\n' % (offset, file),
+                                        b' %d %s\n' % (offset + i * 100, file))
+    warc = tmpdir / (file + '.open')
+    outpath = tmpdir / 'out.cdx'
+
+    # cut in the middle of gzip members
+    cuts = [len(data) // 3, len(data) * 2 // 3]
+    warc.write_binary(data[:cuts[0]])
+    def crawl():
+        for start, end in zip(cuts, cuts[1:] + [len(data)]):
+            time.sleep(0.3)
+            with warc.open('ab') as f:
+                f.write(data[start:end])
+        time.sleep(0.3)
+        warc.rename(tmpdir / file)
+    crawler = threading.Thread(target=crawl)
+    crawler.start()
+
+    args = ['--all-records', '--follow', '--poll-interval=0.1',
+            '--idle-timeout=30', warc.basename, str(outpath)]
+    started = time.time()
+    try:
+        run_main(args, tmpdir, cwd=tmpdir)
+    finally:
+        crawler.join()
+    assert time.time() - started < 10
+    assert outpath.read_binary() == expected
+
+@pytest.mark.parametrize("file", ['uncompressed.warc', 'alexa_short_header.arc.gz'])
+def test_follow_not_warc_gz(file, tmpdir):
+    '''`cdx_writer.py --follow` needs a gzipped WARC file.'''
+    warc = tmpdir / (file + '.open')
+    warc.write_binary(datadir.join(file).read_binary())
+    args = ['--follow', '--poll-interval=0.1', '--idle-timeout=30',
+            str(warc), str(tmpdir / 'out.cdx')]
+    started = time.time()
+    with pytest.raises(ValueError):
+        run_main(args, tmpdir)
+    assert time.time() - started < 10
+
+@pytest.mark.parametrize("interval", [1, 3])
+def test_timing(interval, tmpdir):
+    '''Test `cdx_writer.py --timing-interval=N` writes timings of sampled
+    records by handler class to stats, without changing output.
+    '''
+    file = 'empty-gzips.warc.gz'
+    stats_file = tmpdir / 'stats.json'
+    args = ['--all-records', '--timing-interval=%d' % interval,
+            '--stats-file=' + str(stats_file), file]
+    assert run_main(args, tmpdir) == warcs_all_records[file]
+
+    stats = json.loads(stats_file.read_text('utf-8'))
+    timings = stats['timings']
+    assert 'RevisitHandler' in timings or interval > 1
+    num_sampled = sum(t['records'] for t in timings.values())
+    assert num_sampled == stats['num_records_processed'] // interval
+    for t in timings.values():
+        assert set(t['stages']) == set(['read', 'dispatch', 'exclude', 'fields', 'write'])
+        assert set(t['fields']) == set('N b a m s k r M S V g'.split())
+
+def test_metrics(tmpdir, capsys):
+    '''Test statistics on record types, handlers, skipped records, bytes and
+    times, progress output and Prometheus textfile.
+    '''
+    file = 'empty-gzips.warc.gz'
+    outpath = tmpdir / 'out.cdx'
+    stats_file = tmpdir / 'stats.json'
+    prometheus_file = tmpdir / 'cdx_writer.prom'
+    args = ['--progress', '--progress-interval=0',
+            '--stats-file=' + str(stats_file),
+            '--prometheus-file=' + str(prometheus_file), file, str(outpath)]
+    run_main(args, tmpdir)
+
+    stats = json.loads(stats_file.read_text('utf-8'))
+    assert stats['num_records_processed'] == 9
+    assert stats['num_records_included'] == 3
+    assert sum(stats['records_by_type'].values()) == 9
+    assert stats['records_by_type']['revisit'] == 2
+    assert sum(stats['records_by_handler'].values()) == 3
+    assert stats['records_skipped'] == {'record_type': 6}
+    # excluding empty gzip members
+    assert 0 < stats['bytes_compressed'] < datadir.join(file).size()
+    assert stats['bytes_uncompressed'] > 0
+    assert stats['wall_time'] > 0
+    assert stats['records_per_second'] > 0
+
+    out, err = capsys.readouterr()
+    assert len(err.splitlines()) == 9
+    assert 'ETA' in err
 
+    prom = prometheus_file.read_text('utf-8')
+    assert u'cdx_writer_records_processed_total{file="empty-gzips.warc.gz"} 9\n' in prom
+    assert (u'cdx_writer_records_skipped_total{file="empty-gzips.warc.gz",'
+            u'reason="record_type"} 6\n') in prom
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+"""
+Test cdx_writer.py with synthetic W/ARCs made by warcgen.py.
+"""
+import pytest
+import py
+import sys
+import json
+import gzip
+
+testdir = py.path.local(__file__).dirpath()
+sys.path[0:0] = (str(testdir / '..'), str(testdir))
+import cdx_writer
+import warcgen
+
+def generate(path, records, **kwargs):
+    generator = warcgen.Generator(filename=path.basename, **kwargs)
+    n = warcgen.write_file(str(path), generator, records=records)
+    assert n == records
+    return generator
+
+def test_reproducible(tmpdir):
+    paths = [tmpdir.mkdir(d) / 'synth.warc.gz' for d in ('a', 'b')]
+    for path in paths:
+        generate(path, 50, seed=3, malformed=0.2)
+    assert paths[0].read_binary() == paths[1].read_binary()
+
+@pytest.mark.parametrize("name", ['synth.warc.gz', 'synth.warc', 'synth.arc.gz', 'synth.arc'])
+def test_synthetic(name, tmpdir):
+    '''All generated records, including malformed ones, are read, and
+    special cases are skipped as expected.
+    '''
+    warc = tmpdir / name
+    arc = '.arc' in name
+    generator = generate(warc, 200, arc=arc, malformed=0.3, head_size=2048)
+
+    for all_records in (True, False):
+        stats_file = tmpdir / 'stats-{}.json'.format(all_records)
+        with tmpdir.as_cwd():
+            writer = cdx_writer.CDX_Writer(name, str(tmpdir / 'out.cdx'),
+                                           all_records=all_records,
+                                           stats_file=str(stats_file))
+            writer.make_cdx()
+        stats = json.loads(stats_file.read_text('utf-8'))
+        assert stats['num_records_processed'] == 200
+        assert stats['records_by_type'] == generator.counts
+
+        skipped = stats['records_skipped']
+        cases = generator.cases
+        if arc:
+            assert skipped.get('proxy_failure', 0) == cases.get('proxy_failure', 0)
+            assert skipped.get('negative_length', 0) == cases.get('negative_length', 0)
+        elif not all_records:
+            assert skipped.get('304', 0) == (cases.get('response_304', 0) +
+                                             cases.get('revisit_304', 0))
+
+@pytest.mark.parametrize(["name", "whole_file"], [
+    ('synth.warc.gz', False), ('synth.warc', False),
+    ('synth.arc.gz', False), ('synth.arc', False),
+    ('synth.warc.gz', True), ('synth.arc.gz', True)])
+def test_header_only(name, whole_file, tmpdir):
+    '''Formats without payload fields, read with HeaderReader, have the same
+    values as full format. With `whole_file`, the file is gzipped as one
+    member.
+    '''
+    warc = tmpdir / name
+    if whole_file:
+        uncompressed = tmpdir / warc.purebasename
+        generate(uncompressed, 200, arc='.arc' in name, malformed=0.3,
+                 head_size=2048)
+        with gzip.open(str(warc), 'wb') as f:
+            f.write(uncompressed.read_binary())
+    else:
+        generate(warc, 200, arc='.arc' in name, malformed=0.3, head_size=2048)
+
+    for all_records in (True, False):
+        with tmpdir.as_cwd():
+            writer = cdx_writer.CDX_Writer(name, str(tmpdir / 'full.cdx'),
+                                           all_records=all_records)
+            assert not writer.header_only
+            writer.make_cdx()
+            writer = cdx_writer.CDX_Writer(name, str(tmpdir / 'slim.cdx'),
+                                           format='N b a S V g',
+                                           all_records=all_records)
+            assert writer.header_only
+            writer.make_cdx()
+        full = (tmpdir / 'full.cdx').read_binary().splitlines()[1:]
+        slim = (tmpdir / 'slim.cdx').read_binary().splitlines()[1:]
+        expected = []
+        for line in full:
+            fields = line.split(' ')
+            expected.append(' '.join(fields[0:3] + fields[8:11]))
+        assert slim == expected
+
+@pytest.mark.parametrize("arc", [False, True])
+def test_record_readers(arc, tmpdir):
+    '''MappedReader reading an uncompressed file, and GzipMemberReader
+    reading the same records gzipped, with or without streaming large
+    members, read the same records.
+    '''
+    name = 'synth.arc' if arc else 'synth.warc'
+    for path in (tmpdir / name, tmpdir / (name + '.gz')):
+        generate(path, 200, seed=7, arc=arc, head_size=2048)
+    readers = [
+        cdx_writer.MappedReader((tmpdir / name).open('rb')),
+        cdx_writer.GzipMemberReader((tmpdir / (name + '.gz')).open('rb'),
+                                    blocksize=4096),
+        cdx_writer.GzipMemberReader((tmpdir / (name + '.gz')).open('rb'),
+                                    blocksize=4096, max_member_size=3000),
+        ]
+    mapped, gzipped, streamed = [list(r.read_records()) for r in readers]
+    assert len(mapped) == len(gzipped) == len(streamed) == 200
+
+    num_streamed = 0
+    # the first record has file name in it
+    for m, g, s in zip(mapped, gzipped, streamed)[1:]:
+        m, g, s = m[1], g[1], s[1]
+        assert isinstance(m.content_buffer, buffer)
+        assert isinstance(g.content_buffer, buffer)
+        assert (m.type, m.url, m.date) == (g.type, g.url, g.date)
+        assert m.headers == g.headers
+        assert m.content == g.content
+        assert (m.get_header('WARC-Payload-Digest') ==
+                g.get_header('WARC-Payload-Digest'))
+        if isinstance(s, cdx_writer.StreamedRecord):
+            num_streamed += 1
+            block = ''.join(iter(lambda: s.content_file.read(1000), ''))
+            assert block == g.content[1]
+        else:
+            assert s.content == g.content
+    assert num_streamed > 0
+    for reader in readers:
+        reader.close()
+
+def test_gzip_members(tmpdir):
+    path = tmpdir / 'synth.warc.gz'
+    generate(path, 20)
+    with path.open('rb') as f:
+        members = list(cdx_writer.gzip_members(f, blocksize=1000))
+    with path.open('rb') as f:
+        heads = list(cdx_writer.gzip_members(
+            f, blocksize=100, head_complete=lambda head: len(head) >= 10))
+    assert len(members) == len(heads) == 20
+    pos = 0
+    for (offset, length, data, size), head in zip(members, heads):
+        assert offset == pos
+        assert head[:2] == (offset, length)
+        assert size == head[3] == len(data)
+        assert data.startswith('WARC/1.0\r\n')
+        assert data.startswith(head[2]) and len(head[2]) < len(data)
+        pos += length
+    assert pos == path.size()
+
+def test_gzip_member_file(tmpdir):
+    '''GzipMemberFile stops at end of its member, also when more members
+    follow and `end` is past it.
+    '''
+    path = tmpdir / 'synth.warc.gz'
+    generate(path, 3, seed=3, head_size=100000)
+    with path.open('rb') as f:
+        members = list(cdx_writer.gzip_members(f))
+        for offset, length, data, size in members[:-1]:
+            member = cdx_writer.GzipMemberFile(f, offset, 0, len(data) + 1000,
+                                               blocksize=1000)
+            assert ''.join(iter(lambda: member.read(4096), '')) == data
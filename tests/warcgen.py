@@ -0,0 +1,426 @@
+#!/usr/bin/env python
+"""
+Generate synthetic WARC and ARC files for testing and benchmarking
+cdx_writer.py with data of any size, offline. Output is reproducible:
+the same options (including ``--seed``) always make the same file.
+
+    python tests/warcgen.py --records 100000 --malformed 0.01 synth.warc.gz
+    python tests/warcgen.py --size 10G --max-payload-size 2G big.warc.gz
+    python tests/warcgen.py --arc --head-size 1M synth.arc
+
+Output is gzipped (one member per record) if file name ends with ``.gz``.
+Payloads are generated in chunks, so multi-GB records don't need memory.
+"""
+import sys
+import os
+import re
+import math
+import uuid
+import zlib
+import base64
+import random
+import hashlib
+from datetime import datetime, timedelta
+
+CHUNK_SIZE = 1024 * 1024
+
+# default mix of WARC record types, in relative weights. ``screenshot`` is
+# a metadata record of screenshot image, for --screenshot-mode.
+DEFAULT_MIX = dict(response=60, request=25, metadata=8, revisit=5, resource=2)
+RECORD_KINDS = sorted(DEFAULT_MIX) + ['screenshot']
+
+WARC_MALFORMED = ['bracket_uri', 'space_in_uri', 'blank_content_type',
+                  'response_304', 'revisit_304', 'date_fraction']
+ARC_MALFORMED = ['date_10', 'date_12', 'date_15', 'date_16', 'date_18',
+                 'date_hex', 'date_suffix', 'space_in_url', 'proxy_failure',
+                 'negative_length']
+
+WORDS = ('lorem ipsum dolor sit amet consectetur adipiscing elit sed do '
+         'eiusmod tempor incididunt ut labore et dolore magna aliqua').split()
+
+class Payload(object):
+    """Payload of `size` bytes, `prefix` followed by `pattern` repeated.
+    It is generated in chunks on each iteration.
+    """
+    def __init__(self, prefix, pattern, size):
+        self.prefix = prefix
+        self.pattern = pattern
+        self.size = max(size, len(prefix))
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        yield self.prefix
+        remaining = self.size - len(self.prefix)
+        chunk = self.pattern * (CHUNK_SIZE // len(self.pattern) + 1)
+        while remaining > 0:
+            n = min(remaining, CHUNK_SIZE)
+            yield chunk[:n]
+            remaining -= n
+
+    def sha1(self):
+        h = hashlib.sha1()
+        for chunk in self:
+            h.update(chunk)
+        return base64.b32encode(h.digest())
+
+def iter_parts(parts):
+    for part in parts:
+        if isinstance(part, Payload):
+            for chunk in part:
+                yield chunk
+        else:
+            yield part
+
+class Generator(object):
+    """Generates records as ``(header, parts)``, where `parts` is a list of
+    strings and :class:`Payload` objects making the rest of the record.
+    Number of records generated by record type is in `counts`, and number
+    of malformed records by case in `cases`.
+
+    :param seed: random seed
+    :param arc: generate ARC records instead of WARC records
+    :param filename: file name for ``warcinfo`` / ``filedesc`` record
+    :param hosts: number of distinct hosts in URLs
+    :param mix: dict of WARC record type (or ``screenshot``) to relative
+        weight
+    :param min_payload_size: minimum size of HTTP payloads
+    :param max_payload_size: maximum size of HTTP payloads (sizes are
+        log-uniformly distributed)
+    :param head_size: pad ``<head>`` of HTML payloads to this size
+    :param malformed: fraction of records that are malformed in one of the
+        ways cdx_writer.py handles specially (see `WARC_MALFORMED` and
+        `ARC_MALFORMED`)
+    """
+    def __init__(self, seed=0, arc=False, filename='synthetic.warc.gz',
+                 hosts=100, mix=None, min_payload_size=100,
+                 max_payload_size=100*1024, head_size=0, malformed=0.0):
+        self.rnd = random.Random(seed)
+        self.arc = arc
+        self.filename = filename
+        self.mix = sorted((mix or DEFAULT_MIX).items())
+        self.min_payload_size = max(1, min_payload_size)
+        self.max_payload_size = max(self.min_payload_size, max_payload_size)
+        self.head_size = head_size
+        self.malformed = malformed
+        self.counts = {}
+        self.cases = {}
+
+        tlds = ['com', 'org', 'net', 'de', 'fr', 'jp', 'co.uk']
+        self.hosts = ['www.site{}.{}'.format(i, tlds[i % len(tlds)])
+                      for i in range(hosts)]
+        self.noise = ''.join(chr(self.rnd.randint(0, 255)) for _ in range(4096))
+        self.text = ' '.join(self.rnd.choice(WORDS) for _ in range(200))
+        self.date = datetime(2017, 1, 1)
+        # (url, payload digest) of recent responses, for revisits
+        self.responses = []
+
+    # helpers
+    def count(self, counts, key):
+        counts[key] = counts.get(key, 0) + 1
+
+    def next_date(self):
+        self.date += timedelta(seconds=self.rnd.randint(0, 30))
+        return self.date
+
+    def record_id(self):
+        return '<urn:uuid:{}>'.format(uuid.UUID(int=self.rnd.getrandbits(128), version=4))
+
+    def url(self):
+        path = '/'.join(self.rnd.choice(WORDS) for _ in range(self.rnd.randint(0, 3)))
+        url = 'http://{}/{}'.format(self.rnd.choice(self.hosts), path)
+        if self.rnd.random() < 0.2:
+            url += '?id={}'.format(self.rnd.randint(0, 10**6))
+        return url
+
+    def payload_size(self):
+        return int(math.exp(self.rnd.uniform(math.log(self.min_payload_size),
+                                             math.log(self.max_payload_size))))
+
+    def html_payload(self, size):
+        head = ['<html><head><title>{}</title>\n'.format(self.rnd.choice(WORDS))]
+        if self.rnd.random() < 0.05:
+            head.append('<meta name="robots" content="noindex,nofollow">\n')
+        filler = '<meta name="filler" content="{}">\n'.format(self.text[:100])
+        padding = self.head_size - sum(len(s) for s in head)
+        if padding > 0:
+            head.append(filler * (padding // len(filler) + 1))
+        head.append('</head><body>\n')
+        return Payload(''.join(head), '<p>{}</p>\n'.format(self.text), size)
+
+    def http_response(self, status=200, content_type=None, payload=None):
+        """Return HTTP response header and :class:`Payload`."""
+        if content_type is None:
+            content_type = self.rnd.choice(['text/html'] * 5 + [
+                'image/jpeg', 'text/css', 'application/javascript',
+                'application/pdf'])
+        if payload is None:
+            size = self.payload_size()
+            if content_type == 'text/html':
+                payload = self.html_payload(size)
+            elif content_type.startswith(('text/', 'application/javascript')):
+                payload = Payload('', self.text + '\n', size)
+            else:
+                payload = Payload('', self.noise, size)
+        reasons = {200: 'OK', 301: 'Moved Permanently', 302: 'Found',
+                   304: 'Not Modified', 404: 'Not Found'}
+        lines = ['HTTP/1.1 {} {}'.format(status, reasons[status]),
+                 'Date: {}'.format(self.date.strftime('%a, %d %b %Y %H:%M:%S GMT'))]
+        if status in (301, 302):
+            lines.append('Location: {}'.format(self.url()))
+        if content_type is not None:
+            lines.append('Content-Type: {}'.format(content_type))
+        lines.append('Content-Length: {}'.format(len(payload)))
+        return '\r\n'.join(lines) + '\r\n\r\n', payload
+
+    def random_status(self):
+        return self.rnd.choice([200] * 17 + [301, 302, 404])
+
+    # WARC
+    def warc_record(self, warc_type, url, content_type, parts, headers=(),
+                    date=None):
+        if date is None:
+            date = self.next_date().strftime('%Y-%m-%dT%H:%M:%SZ')
+        length = sum(len(p) for p in parts)
+        lines = ['WARC/1.0',
+                 'WARC-Type: {}'.format(warc_type),
+                 'WARC-Target-URI: {}'.format(url),
+                 'WARC-Date: {}'.format(date),
+                 'WARC-Record-ID: {}'.format(self.record_id())]
+        lines.extend('{}: {}'.format(k, v) for k, v in headers)
+        lines.append('Content-Type: {}'.format(content_type))
+        lines.append('Content-Length: {}'.format(length))
+        self.count(self.counts, warc_type)
+        return '\r\n'.join(lines) + '\r\n\r\n', parts + ['\r\n\r\n']
+
+    def warcinfo(self):
+        fields = 'software: warcgen\r\nformat: WARC File Format 1.0\r\n'
+        return self.warc_record('warcinfo', '', 'application/warc-fields',
+                                [fields], [('WARC-Filename', self.filename)])
+
+    def response(self, url=None, status=None, content_type=None, date=None):
+        url = url or self.url()
+        header, payload = self.http_response(status or self.random_status(),
+                                             content_type)
+        digest = 'sha1:' + payload.sha1()
+        if len(self.responses) >= 1000:
+            self.responses.pop(self.rnd.randrange(len(self.responses)))
+        self.responses.append((url, digest))
+        return self.warc_record('response', url,
+                                'application/http; msgtype=response',
+                                [header, payload],
+                                [('WARC-Payload-Digest', digest)], date)
+
+    def revisit(self, not_modified=False):
+        if not self.responses:
+            return self.response()
+        url, digest = self.rnd.choice(self.responses)
+        if not_modified:
+            header, payload = self.http_response(304, payload=Payload('', ' ', 0))
+            profile = 'http://netpreserve.org/warc/1.0/revisit/server-not-modified'
+        else:
+            header, payload = self.http_response(200, payload=Payload('', ' ', 0))
+            profile = 'http://netpreserve.org/warc/1.0/revisit/identical-payload-digest'
+        return self.warc_record('revisit', url,
+                                'application/http; msgtype=response', [header],
+                                [('WARC-Profile', profile),
+                                 ('WARC-Refers-To-Target-URI', url),
+                                 ('WARC-Payload-Digest', digest)])
+
+    def request(self):
+        url = self.url()
+        host, _, path = url[len('http://'):].partition('/')
+        block = ('GET /{} HTTP/1.1\r\nHost: {}\r\nUser-Agent: warcgen\r\n\r\n'
+                 .format(path, host))
+        return self.warc_record('request', url,
+                                'application/http; msgtype=request', [block])
+
+    def metadata(self):
+        block = ''.join('outlink: {} L a/@href\r\n'.format(self.url())
+                        for _ in range(self.rnd.randint(1, 10)))
+        return self.warc_record('metadata', self.url(),
+                                'application/warc-fields', [block])
+
+    def resource(self):
+        if self.rnd.random() < 0.5:
+            url = 'ftp://ftp.{}/pub/{}.bin'.format(
+                self.rnd.choice(self.hosts)[len('www.'):], self.rnd.choice(WORDS))
+        else:
+            url = self.url()
+        payload = Payload('', self.noise, self.payload_size())
+        return self.warc_record('resource', url, 'application/octet-stream',
+                                [payload])
+
+    def screenshot(self):
+        payload = Payload('\x89PNG\r\n\x1a\n', self.noise, self.payload_size())
+        return self.warc_record('metadata', self.url(), 'image/png', [payload])
+
+    def malformed_warc_record(self, case):
+        if case == 'bracket_uri':
+            return self.response(url='<{}>'.format(self.url()))
+        elif case == 'space_in_uri':
+            return self.response(url=self.url() + ' x')
+        elif case == 'blank_content_type':
+            return self.response(content_type='')
+        elif case == 'response_304':
+            return self.response(status=304)
+        elif case == 'revisit_304':
+            return self.revisit(not_modified=True)
+        elif case == 'date_fraction':
+            date = self.next_date().strftime('%Y-%m-%dT%H:%M:%S.%f') + 'Z'
+            return self.response(date=date)
+
+    # ARC
+    def arc_record(self, url, ip, date, content_type, parts):
+        length = sum(len(p) for p in parts)
+        header = '{} {} {} {} {}\n'.format(url, ip, date, content_type, length)
+        self.count(self.counts, 'filedesc' if url.startswith('filedesc:') else 'response')
+        return header, parts + ['\n']
+
+    def filedesc(self):
+        name = re.sub(r'\.gz$', '', self.filename)
+        block = ('1 0 InternetArchive\n'
+                 'URL IP-address Archive-date Content-type Archive-length\n')
+        return self.arc_record('filedesc://' + name, '0.0.0.0',
+                               self.date.strftime('%Y%m%d%H%M%S'), 'text/plain',
+                               [block])
+
+    def ip(self):
+        return '.'.join(str(self.rnd.randint(1, 254)) for _ in range(4))
+
+    def arc_response(self, url=None, ip=None, date=None):
+        date = date or self.next_date().strftime('%Y%m%d%H%M%S')
+        header, payload = self.http_response(self.random_status())
+        content_type = header.partition('Content-Type: ')[2].partition('\r\n')[0]
+        return self.arc_record(url or self.url(), ip or self.ip(), date,
+                               content_type or 'no-type', [header, payload])
+
+    def malformed_arc_record(self, case):
+        date = self.next_date().strftime('%Y%m%d%H%M%S')
+        if case.startswith('date_'):
+            date = {
+                'date_10': date[:10],
+                'date_12': date[:12],
+                'date_15': date + '0',
+                'date_16': date + '00',
+                'date_18': date + '1234',
+                'date_hex': 'deadbeef{:04x}'.format(self.rnd.getrandbits(16)),
+                'date_suffix': date + 'jpg',
+                }[case]
+            return self.arc_response(date=date)
+        elif case == 'space_in_url':
+            return self.arc_response(url=self.url() + ' x')
+        elif case == 'proxy_failure':
+            return self.arc_record(self.url(), '0.0.0.0', date, 'unk',
+                                   ['HTTP 502 Bad Gateway\n\n'])
+        elif case == 'negative_length':
+            header = '{} {} {} text/html -{}\n'.format(
+                self.url(), self.ip(), date, self.rnd.randint(1, 2**31))
+            self.count(self.counts, 'response')
+            return header, []
+
+    def records(self):
+        """Generate records endlessly."""
+        yield self.filedesc() if self.arc else self.warcinfo()
+        total = sum(weight for _, weight in self.mix)
+        while True:
+            if self.rnd.random() < self.malformed:
+                if self.arc:
+                    case = self.rnd.choice(ARC_MALFORMED)
+                    record = self.malformed_arc_record(case)
+                else:
+                    case = self.rnd.choice(WARC_MALFORMED)
+                    record = self.malformed_warc_record(case)
+                self.count(self.cases, case)
+                yield record
+            elif self.arc:
+                yield self.arc_response()
+            else:
+                r = self.rnd.uniform(0, total)
+                for warc_type, weight in self.mix:
+                    r -= weight
+                    if r <= 0:
+                        break
+                yield getattr(self, warc_type)()
+
+def write_file(path, generator, records=None, size=None):
+    """Write records from `generator` to file `path` until `records` records
+    (including the first ``warcinfo`` or ``filedesc`` record), or `size`
+    bytes (before compression) are written. File is gzipped if `path` ends
+    with ``.gz``. Return number of records written.
+    """
+    gzipped = path.endswith('.gz')
+    num_records = 0
+    written = 0
+    with open(path, 'wb') as f:
+        for header, parts in generator.records():
+            if gzipped:
+                c = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+                f.write(c.compress(header))
+                for chunk in iter_parts(parts):
+                    f.write(c.compress(chunk))
+                f.write(c.flush())
+            else:
+                f.write(header)
+                for chunk in iter_parts(parts):
+                    f.write(chunk)
+            num_records += 1
+            written += len(header) + sum(len(p) for p in parts)
+            if records is not None and num_records >= records:
+                break
+            if size is not None and written >= size:
+                break
+    return num_records
+
+def parse_size(s):
+    """Parse size like ``512``, ``64k``, ``10M`` or ``2G``."""
+    m = re.match(r'(\d+)([kKmMgG]?)$', s)
+    if not m:
+        raise ValueError('invalid size: {}'.format(s))
+    return int(m.group(1)) * {'': 1, 'k': 1024, 'm': 1024**2, 'g': 1024**3}[
+        m.group(2).lower()]
+
+def parse_mix(s):
+    """Parse record type mix like ``response=70,revisit=30``."""
+    mix = {}
+    for item in s.split(','):
+        warc_type, _, weight = item.partition('=')
+        if warc_type not in RECORD_KINDS:
+            raise ValueError('unknown record type: {}'.format(warc_type))
+        mix[warc_type] = float(weight)
+    return mix
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Generate synthetic WARC/ARC file (gzipped if name ends with .gz)")
+    parser.add_argument("output")
+    parser.add_argument("--arc", action="store_true", help="write ARC instead of WARC")
+    parser.add_argument("--records", type=int, help="number of records")
+    parser.add_argument("--size", type=parse_size, help="approximate (uncompressed) file size, like 10G")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--hosts", type=int, default=100, help="number of distinct hosts")
+    parser.add_argument("--mix", type=parse_mix, help="WARC record type weights, like response=60,request=25,metadata=8,revisit=5,resource=2 (also screenshot)")
+    parser.add_argument("--min-payload-size", type=parse_size, default=100)
+    parser.add_argument("--max-payload-size", type=parse_size, default=100*1024)
+    parser.add_argument("--head-size", type=parse_size, default=0, help="pad <head> of HTML payloads to this size")
+    parser.add_argument("--malformed", type=float, default=0.0, help="fraction of malformed records")
+
+    args = parser.parse_args()
+    if args.records is None and args.size is None:
+        parser.error("--records or --size is required")
+
+    generator = Generator(seed=args.seed, arc=args.arc,
+                          filename=os.path.basename(args.output),
+                          hosts=args.hosts, mix=args.mix,
+                          min_payload_size=args.min_payload_size,
+                          max_payload_size=args.max_payload_size,
+                          head_size=args.head_size, malformed=args.malformed)
+    n = write_file(args.output, generator, args.records, args.size)
+    print >>sys.stderr, "Wrote {} records to {}".format(n, args.output)
+    for warc_type, count in sorted(generator.counts.items()):
+        print >>sys.stderr, "  {}: {}".format(warc_type, count)
+    for case, count in sorted(generator.cases.items()):
+        print >>sys.stderr, "  malformed {}: {}".format(case, count)